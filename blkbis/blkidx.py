@@ -8,16 +8,779 @@ This is a module to create and manipulate indices.
 import os
 import sys
 import logging
-import pandas
+import hashlib
+import concurrent.futures
+import numpy as np
+import pandas as pd
 
+import blkbis.dates
 
 logger = logging.getLogger()
 
 
+# Columns that are stored as integer codes into dictionaries shared by all
+# the date blocks of a panel.
+_CODED_COLUMNS = ['id', 'sector']
+_DATE_COLUMN = 'date'
+
+# End date given to membership spells that are still open at the last date
+# of the panel, as in tstdata
+_OPEN_END_DATE = '21001231'
+
+# Weighting schemes supported by the index level calculation
+_WEIGHTING_SCHEMES = ['CAP', 'EQUAL']
+_DEFAULT_BASE_LEVEL = 100.0
+
+# Fixed income analytics that are averaged with market value weights, and the
+# buckets of the letter ratings once the +/- notches are removed
+_FI_FIELDS = ['duration', 'yield', 'spread']
+_RATING_BUCKETS = {'AAA': 'AAA',
+                   'AA': 'AA',
+                   'A': 'A',
+                   'BBB': 'BBB',
+                   'BB': 'BB',
+                   'B': 'B',
+                   'CCC': 'CCC_AND_BELOW',
+                   'CC': 'CCC_AND_BELOW',
+                   'C': 'CCC_AND_BELOW',
+                   'D': 'CCC_AND_BELOW'}
+
+
 def __init__(self):
     print('Main init at the top')
 
 
+def _to_datetime64(date):
+    return pd.Timestamp(date).to_datetime64().astype('datetime64[ns]')
+
+
+def index_returns(df, dates, weighting='CAP', size_column='size_mm'):
+    '''
+    Computes the weights of all the constituents and the chain-linked return of the
+    index for every date of df in a single vectorized pass.
+
+    The return of a date is the weighted average return of the constituents that were
+    already in the index at the previous date, using their previous weights. The return
+    of a constituent is the relative change of its size.
+
+    :param df: panel with date, id and size_column
+    :param dates: sorted dates of the panel, used to find the previous date of each row
+    :param weighting: CAP or EQUAL
+    :param size_column: column used for cap weights and constituent returns
+    :return: a dataframe indexed by date and the dataframe of weights by date and id
+    '''
+
+    if weighting not in _WEIGHTING_SCHEMES:
+        raise ValueError('weighting must be one of %s' % _WEIGHTING_SCHEMES)
+
+    # The sector, when there is one, is carried over to the weights
+    sector = ['sector'] if 'sector' in df.columns else []
+    df = df[[_DATE_COLUMN, 'id', size_column] + sector].dropna(subset=[_DATE_COLUMN, 'id', size_column])
+
+    by_date = df.groupby(_DATE_COLUMN)[size_column]
+    if weighting == 'CAP':
+        weight = df[size_column] / by_date.transform('sum')
+    else:
+        weight = 1.0 / by_date.transform('count')
+
+    positions = pd.DatetimeIndex(dates).get_indexer(pd.DatetimeIndex(df[_DATE_COLUMN]))
+    df = df.assign(weight=weight.values, position=positions).sort_values(['id', 'position'])
+
+    # Looks at the previous row of the same id, if it is the previous date of the panel
+    ids = df['id'].values
+    positions = df['position'].values
+    held = np.zeros(len(df), dtype=bool)
+    held[1:] = (ids[1:] == ids[:-1]) & (positions[1:] == positions[:-1] + 1)
+
+    sizes = df[size_column].values.astype(float)
+    previous_size = np.full(len(df), np.nan)
+    previous_size[1:] = sizes[:-1]
+    previous_weight = np.full(len(df), np.nan)
+    previous_weight[1:] = df['weight'].values[:-1]
+    previous_weight[~held] = np.nan
+
+    held_weight = pd.Series(previous_weight, index=df.index)
+    contribution = held_weight * (sizes / previous_size - 1.0)
+
+    summary = pd.DataFrame({'n_constituents': df.groupby(_DATE_COLUMN)['id'].count(),
+                            'total_size': df.groupby(_DATE_COLUMN)[size_column].sum(),
+                            'contribution': contribution.groupby(df[_DATE_COLUMN]).sum(),
+                            'held_weight': held_weight.groupby(df[_DATE_COLUMN]).sum()})
+
+    # Dates without any constituent held from the previous date carry the level over
+    summary['index_return'] = (summary['contribution'] / summary['held_weight']).where(summary['held_weight'] > 0, 0.0)
+    summary = summary.drop(columns=['contribution', 'held_weight']).sort_index()
+
+    weights = df[[_DATE_COLUMN, 'id'] + sector + ['weight']].sort_values([_DATE_COLUMN, 'id']).reset_index(drop=True)
+
+    return summary, weights
+
+
+def fi_aggregate(df, by, market_value_column='market_value', fields=_FI_FIELDS, rating_column='rating'):
+    '''
+    Aggregates fixed income analytics with a single groupby over df: market value
+    weighted averages of the fields, and the share of market value in each rating
+    bucket. Ratings that are missing or not recognized go into the NR bucket.
+
+    :param df: panel with the market value, the fields and optionally the ratings
+    :param by: list of columns to group by
+    :param market_value_column: column with the market value of the constituents
+    :param fields: columns that are averaged with market value weights
+    :param rating_column: column with the letter ratings, ignored if it is not in df
+    :return: dataframe indexed by the by columns
+    '''
+
+    if market_value_column not in df.columns:
+        raise ValueError('The index data must contain a "%s" column' % market_value_column)
+
+    fields = [f for f in fields if f in df.columns]
+    market_value = df[market_value_column].astype(float)
+
+    # Sums of mv * field and of the mv where the field is known, so that missing
+    # values do not dilute the averages
+    sums = pd.DataFrame({market_value_column: market_value, 'n_constituents': 1}, index=df.index)
+    for f in fields:
+        known = df[f].notnull()
+        sums[f] = (market_value * df[f].astype(float)).where(known, 0.0)
+        sums[f + '_weight'] = market_value.where(known, 0.0)
+
+    if rating_column in df.columns:
+        buckets = df[rating_column].astype(object).str.replace(r'[+-]', '', regex=True).str.strip().map(_RATING_BUCKETS)
+        buckets = buckets.fillna('NR')
+        for bucket in sorted(pd.unique(buckets)):
+            sums['rating_' + bucket] = market_value.where(buckets == bucket, 0.0)
+
+    keys = [df[c] for c in by]
+    result = sums.groupby(keys, observed=True).sum()
+
+    for f in fields:
+        result[f] = result[f] / result.pop(f + '_weight')
+
+    for c in [c for c in result.columns if c.startswith('rating_')]:
+        result[c] = result[c] / result[market_value_column]
+
+    result.index.names = by
+
+    return result
+
+
+class IdxPanel:
+    '''
+    Columnar storage for an historical index panel.
+
+    The panel is kept as one block per date, sorted by date. Each block only holds
+    the rows of its date: the date itself is the position of the block in the sorted
+    array of dates, and the id and sector columns are stored as int32 codes into
+    dictionaries that are shared by all the blocks.
+
+    Looking up a date range is a binary search on the dates, and appending a new
+    period only encodes and stores the rows of that period.
+
+    In compact mode, the numeric columns of the blocks are downcast when it does not
+    change their values, the coded columns are returned as categoricals over the shared
+    dictionaries instead of strings, and the assembled panel is not cached so that only
+    the blocks stay in memory.
+    '''
+
+    def __init__(self, df=None, compact=False):
+
+        self.__dates__ = np.array([], dtype='datetime64[ns]')
+        self.__blocks__ = []
+        self.__dictionaries__ = {}
+        self.__columns__ = []
+        self.__frame__ = None
+        self.__spells__ = None
+        self.__compact__ = compact
+        self.__fingerprints__ = {}
+        self.__cube__ = None
+
+        if df is not None:
+            self.append(df)
+
+
+    def __len__(self):
+        return sum(len(b) for b in self.__blocks__)
+
+
+    @property
+    def dates(self):
+        return pd.DatetimeIndex(self.__dates__, name=_DATE_COLUMN)
+
+
+    def _encode(self, column, values):
+        '''
+        Converts the values of a coded column into integer codes, extending the
+        shared dictionary with the values that were never seen before.
+
+        :param column: name of the coded column
+        :param values: values to encode
+        :return: numpy array of int32 codes, -1 for missing values
+        '''
+
+        values = np.asarray(values, dtype=object)
+        categories = self.__dictionaries__.get(column, pd.Index([], dtype=object))
+        codes = categories.get_indexer(values)
+
+        unseen = values[codes == -1]
+        unseen = pd.unique(unseen[~pd.isnull(unseen)])
+        if len(unseen):
+            categories = categories.append(pd.Index(unseen, dtype=object))
+            codes = categories.get_indexer(values)
+
+        self.__dictionaries__[column] = categories
+
+        return codes.astype(np.int32)
+
+
+    def _decode(self, column, codes):
+        values = pd.Categorical.from_codes(codes, categories=self.__dictionaries__[column])
+
+        if self.__compact__:
+            return values
+
+        return np.asarray(values, dtype=object)
+
+
+    @staticmethod
+    def _downcast(block):
+        '''
+        Downcasts the integer columns, and the float columns whose values are all exactly
+        represented in float32, so that compaction never changes the stored values.
+        '''
+
+        for c in block.columns:
+            if pd.api.types.is_float_dtype(block[c]):
+                values = block[c].values
+                if values.dtype != np.float32 and np.array_equal(values.astype(np.float32).astype(values.dtype), values,
+                                                                 equal_nan=True):
+                    block[c] = values.astype(np.float32)
+            elif pd.api.types.is_integer_dtype(block[c]):
+                block[c] = pd.to_numeric(block[c], downcast='integer')
+
+        return block
+
+
+    def compact(self):
+        '''
+        Switches the panel to compact mode and downcasts the existing blocks.
+
+        :return: None
+        '''
+
+        self.__compact__ = True
+        self.__blocks__ = [self._downcast(b) for b in self.__blocks__]
+        self.__frame__ = None
+        self.__spells__ = None
+
+
+    def memory_report(self):
+        '''
+        Compares, column by column, the memory used by the assembled dataframe with
+        plain dtypes and the memory used by the blocks of the panel.
+
+        :return: dataframe indexed by column with plain_bytes, compact_bytes and ratio
+        '''
+
+        compact = self.__compact__
+        self.__compact__ = False
+        try:
+            df = self._assemble(range(len(self.__blocks__)))
+        finally:
+            self.__compact__ = compact
+
+        # Measures the numeric columns with the 64 bits they would have without compaction
+        for c in df.columns:
+            if pd.api.types.is_float_dtype(df[c]):
+                df[c] = df[c].astype(np.float64)
+            elif pd.api.types.is_integer_dtype(df[c]):
+                df[c] = df[c].astype(np.int64)
+
+        plain = df.memory_usage(index=False, deep=True)
+
+        report = pd.DataFrame({'plain_bytes': plain}, columns=['plain_bytes', 'compact_bytes'])
+
+        for c in self.__columns__:
+            if c == _DATE_COLUMN:
+                report.loc[c, 'compact_bytes'] = self.__dates__.nbytes
+            else:
+                report.loc[c, 'compact_bytes'] = sum(b[c].memory_usage(index=False, deep=True) for b in self.__blocks__ if c in b.columns)
+
+            if c in self.__dictionaries__:
+                report.loc[c, 'compact_bytes'] += self.__dictionaries__[c].memory_usage(deep=True)
+
+        report.loc['total'] = report.sum()
+        report['ratio'] = report['plain_bytes'] / report['compact_bytes']
+
+        return report
+
+
+    def _insert_block(self, date, block):
+        pos = np.searchsorted(self.__dates__, date)
+        self.__fingerprints__.pop(date, None)
+
+        if pos < len(self.__dates__) and self.__dates__[pos] == date:
+            self.__blocks__[pos] = pd.concat([self.__blocks__[pos], block], ignore_index=True, sort=False)
+        else:
+            self.__dates__ = np.insert(self.__dates__, pos, date)
+            self.__blocks__.insert(pos, block)
+
+        if self.__cube__ is not None:
+            self.__cube__['entries'][date] = self._cube_entry(self.__blocks__[pos])
+            self.__cube__['frame'] = None
+
+
+    def append(self, df):
+        '''
+        Adds the rows of df to the panel. Dates that are already in the panel are
+        extended, new dates get their own block.
+
+        :param df: dataframe with at least a date column
+        :return: None
+        '''
+
+        if _DATE_COLUMN not in df.columns:
+            raise ValueError('The panel must contain a "%s" column' % _DATE_COLUMN)
+
+        for c in df.columns:
+            if c not in self.__columns__:
+                self.__columns__.append(c)
+
+        dates = pd.to_datetime(df[_DATE_COLUMN]).values.astype('datetime64[ns]')
+        data = df.drop(columns=[_DATE_COLUMN])
+
+        for c in _CODED_COLUMNS:
+            if c in data.columns:
+                data[c] = self._encode(c, data[c])
+
+        # Splits the rows by date with a single stable sort
+        order = np.argsort(dates, kind='mergesort')
+        dates = dates[order]
+        data = data.iloc[order]
+
+        unique_dates, starts = np.unique(dates, return_index=True)
+        bounds = np.append(starts, len(dates))
+
+        if self.__compact__:
+            data = self._downcast(data)
+
+        for i, date in enumerate(unique_dates):
+            self._insert_block(date, data.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True))
+
+        self.__frame__ = None
+        self.__spells__ = None
+
+
+    def _assemble(self, positions):
+        blocks = [self.__blocks__[p] for p in positions]
+
+        if not blocks:
+            return pd.DataFrame(columns=self.__columns__)
+
+        df = pd.concat(blocks, ignore_index=True, sort=False)
+        df[_DATE_COLUMN] = np.repeat(self.__dates__[np.asarray(positions, dtype=int)], [len(b) for b in blocks])
+
+        for c in self.__dictionaries__:
+            df[c] = self._decode(c, df[c].values)
+
+        return df[self.__columns__]
+
+
+    def frame(self):
+        '''
+        Assembles the whole panel into a single dataframe. Outside of compact mode, the
+        result is cached until the panel changes.
+
+        :return: dataframe
+        '''
+
+        if self.__compact__:
+            return self._assemble(range(len(self.__blocks__)))
+
+        if self.__frame__ is None:
+            self.__frame__ = self._assemble(range(len(self.__blocks__)))
+
+        return self.__frame__
+
+
+    def between(self, start_date=None, end_date=None):
+        '''
+        Assembles the rows whose date is in [start_date, end_date].
+
+        :param start_date: first date, or None to start at the beginning
+        :param end_date: last date, or None to go until the end
+        :return: dataframe
+        '''
+
+        start = 0 if start_date is None else np.searchsorted(self.__dates__, _to_datetime64(start_date), side='left')
+        stop = len(self.__dates__) if end_date is None else np.searchsorted(self.__dates__, _to_datetime64(end_date), side='right')
+
+        return self._assemble(range(start, stop))
+
+
+    def take(self, positions):
+        '''
+        Assembles the blocks at the given positions in the sorted dates.
+
+        :param positions: sorted positions of the dates
+        :return: dataframe
+        '''
+
+        return self._assemble(positions)
+
+
+    def select(self, dates):
+        '''
+        Assembles the blocks of the given dates, ignoring the dates that are not in the panel.
+
+        :param dates: dates to select
+        :return: dataframe
+        '''
+
+        dates = pd.DatetimeIndex(dates).values.astype('datetime64[ns]')
+        positions = np.unique(np.searchsorted(self.__dates__, dates))
+        positions = positions[positions < len(self.__dates__)]
+
+        return self._assemble(positions[np.isin(self.__dates__[positions], dates)])
+
+
+    def _fingerprint(self, position):
+        block = self.__blocks__[position].copy()
+
+        # Hashes the decoded values with 64-bit numerics so that compaction, which only
+        # downcasts lossless columns, and the order of the dictionaries do not change the fingerprint
+        for c in block.columns:
+            if c in self.__dictionaries__:
+                block[c] = np.asarray(self._decode(c, block[c].values), dtype=object)
+            elif pd.api.types.is_float_dtype(block[c]):
+                block[c] = block[c].astype(np.float64)
+            elif pd.api.types.is_integer_dtype(block[c]):
+                block[c] = block[c].astype(np.int64)
+
+        block = block[sorted(block.columns)]
+        rows = np.sort(pd.util.hash_pandas_object(block, index=False).values)
+
+        digest = hashlib.sha1(','.join(block.columns).encode('utf-8'))
+        digest.update(rows.tobytes())
+
+        return digest.hexdigest()
+
+
+    def fingerprints(self):
+        '''
+        Computes a content hash of each date block. The hash does not depend on the
+        order of the rows. Hashes are kept until their block changes.
+
+        :return: series of hex digests indexed by date
+        '''
+
+        for i, date in enumerate(self.__dates__):
+            if date not in self.__fingerprints__:
+                self.__fingerprints__[date] = self._fingerprint(i)
+
+        return pd.Series([self.__fingerprints__[d] for d in self.__dates__], index=self.dates, name='fingerprint')
+
+
+    def _cube_entry(self, block):
+        '''
+        Aggregates one date block by sector code.
+
+        :return: tuple of the sector codes, counts and total sizes
+        '''
+
+        codes = block['sector'].values.astype(np.int64)
+        sizes = np.nan_to_num(block[self.__cube__['size_column']].values.astype(float))
+
+        keep = codes >= 0
+        codes, inverse = np.unique(codes[keep], return_inverse=True)
+
+        return (codes,
+                np.bincount(inverse, minlength=len(codes)),
+                np.bincount(inverse, weights=sizes[keep], minlength=len(codes)))
+
+
+    def materialize_cube(self, size_column='size_mm'):
+        '''
+        Builds the sector x date aggregate cube. The cube is kept next to the blocks
+        and the entry of a date is updated whenever rows are added to that date.
+
+        :param size_column: column whose total is kept in the cube
+        :return: None
+        '''
+
+        if 'sector' not in self.__dictionaries__:
+            raise ValueError('The panel must contain a "sector" column')
+        if size_column not in self.__columns__:
+            raise ValueError('The panel does not contain a "%s" column' % size_column)
+
+        self.__cube__ = {'size_column': size_column, 'entries': {}, 'frame': None}
+
+        for date, block in zip(self.__dates__, self.__blocks__):
+            self.__cube__['entries'][date] = self._cube_entry(block)
+
+
+    def cube(self, start_date=None, end_date=None):
+        '''
+        Returns the cube between two dates, bounds included, without reading the blocks.
+
+        :param start_date: first date, or None to start at the beginning
+        :param end_date: last date, or None to go until the end
+        :return: dataframe indexed by (date, sector) with n_constituents, total_size and weight
+        '''
+
+        if self.__cube__ is None:
+            raise ValueError('The cube has not been materialized')
+
+        if start_date is None and end_date is None and self.__cube__['frame'] is not None:
+            return self.__cube__['frame']
+
+        start = 0 if start_date is None else np.searchsorted(self.__dates__, _to_datetime64(start_date), side='left')
+        stop = len(self.__dates__) if end_date is None else np.searchsorted(self.__dates__, _to_datetime64(end_date), side='right')
+
+        entries = [self.__cube__['entries'][d] for d in self.__dates__[start:stop]]
+        lengths = [len(e[0]) for e in entries]
+        positions = np.repeat(np.arange(len(entries)), lengths)
+
+        def stack(i, dtype):
+            return np.concatenate([e[i] for e in entries]).astype(dtype) if entries else np.array([], dtype=dtype)
+
+        codes = stack(0, np.int64)
+        totals = stack(2, float)
+
+        cube = pd.DataFrame({'n_constituents': stack(1, np.int64),
+                             'total_size': totals,
+                             'weight': totals / np.bincount(positions, weights=totals, minlength=len(entries))[positions]},
+                            index=pd.MultiIndex.from_arrays([self.__dates__[start:stop][positions],
+                                                             self._decode('sector', codes)],
+                                                            names=[_DATE_COLUMN, 'sector']),
+                            columns=['n_constituents', 'total_size', 'weight'])
+
+        if start_date is None and end_date is None:
+            self.__cube__['frame'] = cube
+
+        return cube
+
+
+    def _build_spells(self):
+        '''
+        Builds the membership spells of the panel: one row per id and run of
+        consecutive dates on which the id is present, with the effective_date and
+        next_effective_date of the run.
+        '''
+
+        if 'id' not in self.__dictionaries__:
+            raise ValueError('The panel must contain an "id" column')
+
+        if self.__blocks__:
+            codes = np.concatenate([b['id'].values for b in self.__blocks__])
+            positions = np.repeat(np.arange(len(self.__blocks__)), [len(b) for b in self.__blocks__])
+        else:
+            codes = np.array([], dtype=np.int32)
+            positions = np.array([], dtype=np.int64)
+
+        keep = codes >= 0
+        codes = codes[keep]
+        positions = positions[keep]
+
+        # Sorts by (id, date) and drops duplicated rows
+        order = np.lexsort((positions, codes))
+        codes = codes[order]
+        positions = positions[order]
+
+        duplicated = np.zeros(len(codes), dtype=bool)
+        duplicated[1:] = (codes[1:] == codes[:-1]) & (positions[1:] == positions[:-1])
+        codes = codes[~duplicated]
+        positions = positions[~duplicated]
+
+        # A spell starts when the id changes or when the id skipped a date
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (positions[1:] != positions[:-1] + 1)
+        last = np.ones(len(codes), dtype=bool)
+        last[:-1] = first[1:]
+
+        next_dates = np.append(self.__dates__, _to_datetime64(_OPEN_END_DATE))
+
+        spells = pd.DataFrame({'id': self._decode('id', codes[first]),
+                               'effective_date': self.__dates__[positions[first]],
+                               'next_effective_date': next_dates[positions[last] + 1]},
+                              columns=['id', 'effective_date', 'next_effective_date'])
+
+        intervals = pd.IntervalIndex.from_arrays(spells['effective_date'], spells['next_effective_date'], closed='left')
+        by_start = np.argsort(spells['effective_date'].values, kind='mergesort')
+
+        self.__spells__ = (spells, codes[first], intervals, by_start)
+
+
+    def spells(self):
+        '''
+        Returns the membership spells sorted by id code, the id codes of the spells, the
+        interval index of the spells and the order of the spells by effective_date. They
+        are built once and kept until the panel changes.
+        '''
+
+        if self.__spells__ is None:
+            self._build_spells()
+
+        return self.__spells__
+
+
+    def constituents_at(self, date):
+        '''
+        Looks up the spells that contain date in the interval tree of the spells.
+
+        :param date: as-of date
+        :return: dataframe of the spells
+        '''
+
+        spells, codes, intervals, by_start = self.spells()
+        indexer = intervals.get_indexer_non_unique(pd.DatetimeIndex([_to_datetime64(date)]))[0]
+
+        return spells.iloc[np.sort(indexer[indexer >= 0])].reset_index(drop=True)
+
+
+    def membership_history(self, id):
+        '''
+        Finds the spells of one id with a binary search on the sorted id codes.
+
+        :param id: id of the security
+        :return: dataframe of the spells, sorted by effective_date
+        '''
+
+        spells, codes, intervals, by_start = self.spells()
+        code = self.__dictionaries__['id'].get_indexer([id])[0]
+
+        if code < 0:
+            return spells.iloc[0:0].reset_index(drop=True)
+
+        start = np.searchsorted(codes, code, side='left')
+        stop = np.searchsorted(codes, code, side='right')
+
+        return spells.iloc[start:stop].reset_index(drop=True)
+
+
+    def constituents_between(self, start_date, end_date):
+        '''
+        Returns the spells that overlap [start_date, end_date]: the spells that contain
+        start_date, looked up in the interval tree of the spells, and the spells that
+        start after start_date and on or before end_date, found with a binary search on
+        the spells sorted by effective_date.
+
+        :param start_date: first date
+        :param end_date: last date
+        :return: dataframe of the spells, sorted by id code
+        '''
+
+        spells, codes, intervals, by_start = self.spells()
+        start_date = _to_datetime64(start_date)
+        end_date = _to_datetime64(end_date)
+
+        if end_date < start_date:
+            return spells.iloc[0:0].reset_index(drop=True)
+
+        containing = intervals.get_indexer_non_unique(pd.DatetimeIndex([start_date]))[0]
+
+        starts = spells['effective_date'].values[by_start]
+        first = np.searchsorted(starts, start_date, side='right')
+        last = np.searchsorted(starts, end_date, side='right')
+
+        positions = np.union1d(containing[containing >= 0], by_start[first:last])
+
+        return spells.iloc[positions].reset_index(drop=True)
+
+
+
+
+class ParquetSource:
+    '''
+    Parquet file from which an index panel is loaded lazily.
+
+    Opening the source only reads the footer of the file: the row groups whose
+    statistics show that they cannot contain the requested dates or sectors are
+    pruned right away, and the remaining row groups are read, for the requested
+    columns only, when the panel is first needed.
+    '''
+
+    def __init__(self, path, dates=None, sectors=None, columns=None):
+
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.parquet_file = pq.ParquetFile(path)
+
+        if dates is None:
+            self.start_date, self.end_date = None, None
+        else:
+            self.start_date, self.end_date = [None if d is None else pd.Timestamp(d) for d in dates]
+
+        self.sectors = None if sectors is None else list(sectors)
+
+        self.columns = None
+        if columns is not None:
+            self.columns = list(columns)
+            for c in [_DATE_COLUMN] + ([] if self.sectors is None else ['sector']):
+                if c not in self.columns:
+                    self.columns.append(c)
+
+        self.row_groups = self._prune_row_groups()
+        logger.debug('Keeping %d row groups out of %d in %s', len(self.row_groups),
+                     self.parquet_file.num_row_groups, self.path)
+
+
+    def _statistics(self, row_group, column):
+        metadata = self.parquet_file.metadata
+        names = metadata.schema.names
+
+        if column not in names:
+            return None
+
+        statistics = metadata.row_group(row_group).column(names.index(column)).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+
+        return statistics.min, statistics.max
+
+
+    def _keep_row_group(self, row_group):
+        dates = self._statistics(row_group, _DATE_COLUMN)
+        if dates is not None:
+            if self.start_date is not None and pd.Timestamp(dates[1]) < self.start_date:
+                return False
+            if self.end_date is not None and pd.Timestamp(dates[0]) > self.end_date:
+                return False
+
+        sectors = self._statistics(row_group, 'sector')
+        if sectors is not None and self.sectors is not None:
+            if not any(sectors[0] <= s <= sectors[1] for s in self.sectors):
+                return False
+
+        return True
+
+
+    def _prune_row_groups(self):
+        return [i for i in range(self.parquet_file.num_row_groups) if self._keep_row_group(i)]
+
+
+    def read(self):
+        '''
+        Reads the row groups that were kept and applies the filters on the rows.
+
+        :return: dataframe
+        '''
+
+        df = self.parquet_file.read_row_groups(self.row_groups, columns=self.columns).to_pandas()
+
+        mask = np.ones(len(df), dtype=bool)
+        if self.start_date is not None:
+            mask &= (pd.to_datetime(df[_DATE_COLUMN]) >= self.start_date).values
+        if self.end_date is not None:
+            mask &= (pd.to_datetime(df[_DATE_COLUMN]) <= self.end_date).values
+        if self.sectors is not None:
+            mask &= df['sector'].isin(self.sectors).values
+
+        return df[mask]
+
+
+
+
 class BlkIdx:
 
 
@@ -30,9 +793,280 @@ class BlkIdx:
 
         # If a pandas dataframe is given, then uses it to create the index
         if 'dataframe' in kwargs:
-            self.idxdata = kwargs['dataframe']
-            print('LUDO')
+            self.__panel__ = IdxPanel(kwargs['dataframe'], compact=kwargs.get('compact', False))
+            logger.debug('Loaded %d rows over %d dates', len(self.__panel__), len(self.__panel__.dates))
+
+        # Refix dates of the index, see dates.DatesSeries.build_refix_dates
+        if 'refix_dates' in kwargs:
+            self.refix_dates = pd.DatetimeIndex(kwargs['refix_dates']).sort_values()
+
+
+    @classmethod
+    def from_parquet(cls, path, name=None, dates=None, sectors=None, columns=None, **kwargs):
+        '''
+        Opens an index saved in parquet format. Only the metadata of the file is read
+        here, the data is loaded the first time it is needed.
+
+        :param path: path of the parquet file
+        :param name: name of the index, defaults to the file name
+        :param dates: optional (start_date, end_date) tuple, either bound can be None
+        :param sectors: optional list of sectors to load
+        :param columns: optional list of columns to load, date is always loaded
+        :param kwargs: other arguments of the index constructor
+        :return: the index
+        '''
+
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+
+        idx = cls(name, **kwargs)
+        idx.__source__ = ParquetSource(path, dates=dates, sectors=sectors, columns=columns)
+        idx.__compact_source__ = kwargs.get('compact', False)
+
+        return idx
+
+
+    def __getattr__(self, name):
+        # Only called for missing attributes: loads the panel of an index opened
+        # with from_parquet the first time it is needed
+        if name == '__panel__' and '__source__' in self.__dict__:
+            source = self.__dict__.pop('__source__')
+            self.__panel__ = IdxPanel(source.read(), compact=self.__dict__.get('__compact_source__', False))
+            return self.__panel__
+
+        raise AttributeError(name)
+
+
+    # The panel is stored by date in an IdxPanel and only assembled on demand
+    @property
+    def idxdata(self):
+        return self.__panel__.frame()
+
+
+    @idxdata.setter
+    def idxdata(self, df):
+        self.__panel__ = IdxPanel(df)
+
+
+    @property
+    def dates(self):
+        return self.__panel__.dates
+
+
+    def slice_dates(self, start_date=None, end_date=None):
+        '''
+        Returns the rows of the index between two dates, bounds included.
+
+        :param start_date: first date, or None to start at the beginning
+        :param end_date: last date, or None to go until the end
+        :return: dataframe
+        '''
+
+        return self.__panel__.between(start_date, end_date)
+
+
+    def select_dates(self, dates):
+        '''
+        Returns the rows of the index for a list of dates.
+
+        :param dates: dates to select, the ones that are not in the index are ignored
+        :return: dataframe
+        '''
+
+        return self.__panel__.select(dates)
+
+
+    def fingerprints(self):
+        '''
+        :return: series of content hashes of the index data, one per date
+        '''
+
+        return self.__panel__.fingerprints()
+
+
+    def append_period(self, df):
+        '''
+        Adds the rows of a new period to the index. Only the new rows are encoded,
+        the existing history is left untouched.
+
+        :param df: dataframe with the same columns as the index data
+        :return: None
+        '''
+
+        if not hasattr(self, '__panel__'):
+            self.__panel__ = IdxPanel()
+
+        self.__panel__.append(df)
+
+
+    def constituents_at(self, date):
+        '''
+        Returns the securities that were in the index on a given date.
 
+        :param date: as-of date
+        :return: dataframe with id, effective_date and next_effective_date
+        '''
+
+        return self.__panel__.constituents_at(date)
+
+
+    def membership_history(self, id):
+        '''
+        Returns the periods during which a security was in the index.
+
+        :param id: id of the security
+        :return: dataframe with id, effective_date and next_effective_date
+        '''
+
+        return self.__panel__.membership_history(id)
+
+
+    def constituents_between(self, start_date, end_date):
+        '''
+        Returns the securities that were in the index at any time between two dates,
+        bounds included.
+
+        :param start_date: first date
+        :param end_date: last date
+        :return: dataframe with id, effective_date and next_effective_date
+        '''
+
+        return self.__panel__.constituents_between(start_date, end_date)
+
+
+    def materialize_cube(self, size_column='size_mm'):
+        '''
+        Builds the sector x date aggregate cube of the index. Once built, the cube is
+        kept up to date by append_period.
+
+        :param size_column: column whose total is kept in the cube
+        :return: None
+        '''
+
+        self.__panel__.materialize_cube(size_column)
+
+
+    def cube(self, start_date=None, end_date=None):
+        '''
+        :param start_date: first date, or None to start at the beginning
+        :param end_date: last date, or None to go until the end
+        :return: the counts, total size and weight of each sector by date
+        '''
+
+        return self.__panel__.cube(start_date, end_date)
+
+
+    def rollup(self, by=_DATE_COLUMN, start_date=None, end_date=None):
+        '''
+        Rolls the cube up by date or by sector. When rolling up by sector, the weight
+        of a sector is its share of the total size over all the dates.
+
+        :param by: date or sector
+        :param start_date: first date, or None to start at the beginning
+        :param end_date: last date, or None to go until the end
+        :return: dataframe indexed by the by level with n_constituents and total_size, and weight by sector
+        '''
+
+        rollup = self.cube(start_date, end_date)[['n_constituents', 'total_size']].groupby(level=by, observed=True).sum()
+
+        if by == 'sector':
+            rollup['weight'] = rollup['total_size'] / rollup['total_size'].sum()
+
+        return rollup
+
+
+    def compact(self):
+        '''
+        Switches the index data to its memory-compact representation: numeric columns
+        are downcast when it does not change their values, and id/sector are returned as categoricals sharing the dictionaries
+        of the panel. The same can be obtained with compact=True in the constructor.
+
+        :return: None
+        '''
+
+        self.__panel__.compact()
+
+
+    def memory_report(self):
+        '''
+        :return: the per-column memory used by the index data, before and after compaction
+        '''
+
+        return self.__panel__.memory_report()
+
+
+    def refix_periods(self, refix_dates=None):
+        '''
+        Maps every date of the index to the refix that governs it.
+
+        :param refix_dates: refix dates, defaults to the refix dates of the index
+        :return: series of refix dates indexed by the dates of the index
+        '''
+
+        if refix_dates is None:
+            refix_dates = self.refix_dates
+
+        return blkbis.dates.governing_refix_dates(refix_dates, self.dates)
+
+
+    def rebalance_report(self, refix_dates=None, weight_column=None):
+        '''
+        Computes the adds, deletes and one-way turnover between consecutive refixes.
+
+        The constituents of a refix are the ones of the first date of the index on or
+        after the refix date. Only those dates are read from the panel, and each refix
+        is compared with the previous one through a single merge on (refix, id).
+
+        :param refix_dates: refix dates, defaults to the refix dates of the index
+        :param weight_column: column used to weight the constituents, equal weights if None
+        :return: dataframe indexed by refix_date with effective_date, n_constituents, adds, deletes and turnover,
+            adds, deletes and turnover being NaN for the first refix
+        '''
+
+        if refix_dates is None:
+            refix_dates = self.refix_dates
+
+        refix_dates = pd.DatetimeIndex(refix_dates).sort_values()
+        dates = self.dates
+
+        # Several refixes that fall between the same two dates share their first date
+        positions = dates.searchsorted(refix_dates, side='left')
+        keep = positions < len(dates)
+        positions, first = np.unique(positions[keep], return_index=True)
+        refix_dates = refix_dates[keep][first]
+
+        df = self.__panel__.take(positions)
+        df['refix'] = np.searchsorted(positions, dates.get_indexer(pd.DatetimeIndex(df[_DATE_COLUMN])))
+
+        if weight_column is None:
+            df['weight'] = 1.0
+        else:
+            df['weight'] = df[weight_column].astype(float)
+
+        snapshots = df.groupby(['refix', 'id'], as_index=False, observed=True)['weight'].sum()
+        snapshots['weight'] = snapshots['weight'] / snapshots.groupby('refix')['weight'].transform('sum')
+
+        previous = snapshots.assign(refix=snapshots['refix'] + 1)
+        previous = previous[previous['refix'] < len(positions)]
+
+        changes = snapshots.merge(previous, on=['refix', 'id'], how='outer', suffixes=('', '_previous'), indicator=True)
+        changes['n_constituents'] = (changes['_merge'] != 'right_only').astype(int)
+        changes['adds'] = (changes['_merge'] == 'left_only').astype(int)
+        changes['deletes'] = (changes['_merge'] == 'right_only').astype(int)
+        changes['turnover'] = 0.5 * (changes['weight'].fillna(0.0) - changes['weight_previous'].fillna(0.0)).abs()
+
+        columns = ['n_constituents', 'adds', 'deletes', 'turnover']
+        report = changes.groupby('refix')[columns].sum().reindex(range(len(positions)))
+        report.index = pd.DatetimeIndex(refix_dates, name='refix_date')
+        report.insert(0, 'effective_date', dates[positions])
+
+        # There is nothing to compare the first refix with
+        changed = ['adds', 'deletes', 'turnover']
+        report[changed] = report[changed].astype(float)
+        if len(report):
+            report.iloc[0, [report.columns.get_loc(c) for c in changed]] = np.nan
+
+        return report
 
 
     def info(self):
@@ -62,6 +1096,88 @@ class BlkEQIdx(BlkIdx):
         BlkIdx.__init__(self, name, **kwargs)
 
 
+    def compute_levels(self, weighting='CAP', size_column='size_mm', base_level=_DEFAULT_BASE_LEVEL):
+        '''
+        Computes the weights, returns and levels of the index over the whole history.
+        The settings are kept so that the levels are extended when new periods are appended.
+
+        :param weighting: CAP for cap-weighted or EQUAL for equal-weighted
+        :param size_column: column with the size of the constituents
+        :param base_level: level of the index at the first date
+        :return: dataframe indexed by date with n_constituents, total_size, index_return, level and divisor
+        '''
+
+        self.__level_settings__ = {'weighting': weighting, 'size_column': size_column}
+
+        summary, weights = index_returns(self.idxdata, self.dates, weighting, size_column)
+
+        self.__levels__ = self._chain_levels(summary, base_level)
+        self.__weights__ = weights
+
+        return self.__levels__
+
+
+    @staticmethod
+    def _chain_levels(summary, last_level):
+        summary['level'] = last_level * (1.0 + summary['index_return']).cumprod()
+        summary['divisor'] = summary['total_size'] / summary['level']
+        return summary
+
+
+    def _extend_levels(self):
+        '''
+        Extends the levels to the dates that follow the last computed date, starting
+        from the last level. Only the last computed date and the new dates are read.
+        '''
+
+        last_date = self.__levels__.index[-1]
+        summary, weights = index_returns(self.slice_dates(last_date, None), self.dates, **self.__level_settings__)
+
+        summary = self._chain_levels(summary.iloc[1:].copy(), self.__levels__['level'].iloc[-1])
+        weights = weights[weights[_DATE_COLUMN] > last_date]
+
+        self.__levels__ = pd.concat([self.__levels__, summary], sort=False)
+        self.__weights__ = pd.concat([self.__weights__, weights], ignore_index=True)
+
+
+    def append_period(self, df):
+        '''
+        Adds the rows of a new period to the index. If the levels were already computed,
+        they are extended from the last level rather than recomputed over the history.
+
+        :param df: dataframe with the same columns as the index data
+        :return: None
+        '''
+
+        BlkIdx.append_period(self, df)
+
+        if hasattr(self, '__levels__'):
+            if pd.to_datetime(df[_DATE_COLUMN]).min() > self.__levels__.index[-1]:
+                self._extend_levels()
+            else:
+                self.compute_levels(base_level=self.__levels__['level'].iloc[0], **self.__level_settings__)
+
+
+    def levels(self):
+        '''
+        :return: the index levels computed by compute_levels
+        '''
+
+        return self.__levels__
+
+
+    def weights(self, date=None):
+        '''
+        :param date: optional date to restrict the weights to
+        :return: the constituent weights computed by compute_levels
+        '''
+
+        if date is None:
+            return self.__weights__
+
+        return self.__weights__[self.__weights__[_DATE_COLUMN] == _to_datetime64(date)]
+
+
 
 
 class BlkFIIdx(BlkIdx):
@@ -70,6 +1186,46 @@ class BlkFIIdx(BlkIdx):
         BlkIdx.__init__(self, name, **kwargs)
 
 
+    def aggregate(self,
+                  by=('date', 'sector'),
+                  market_value_column='market_value',
+                  fields=_FI_FIELDS,
+                  rating_column='rating',
+                  n_jobs=1):
+        '''
+        Computes the market value weighted duration, yield and spread and the rating
+        buckets of the index for every group of by, over the whole history.
+
+        With n_jobs > 1, the dates are split into n_jobs contiguous partitions that are
+        aggregated in a process pool. This requires date to be one of the by columns.
+
+        :param by: columns to group by
+        :param market_value_column: column with the market value of the constituents
+        :param fields: columns that are averaged with market value weights
+        :param rating_column: column with the letter ratings
+        :param n_jobs: number of processes
+        :return: dataframe indexed by the by columns, see fi_aggregate
+        '''
+
+        by = list(by)
+        args = (by, market_value_column, fields, rating_column)
+
+        if n_jobs <= 1 or len(self.dates) < 2:
+            return fi_aggregate(self.idxdata, *args)
+
+        if _DATE_COLUMN not in by:
+            raise ValueError('Parallel aggregation requires "%s" in by' % _DATE_COLUMN)
+
+        partitions = [p for p in np.array_split(np.arange(len(self.dates)), n_jobs) if len(p)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(fi_aggregate, self.__panel__.take(p), *args) for p in partitions]
+            results = [f.result() for f in futures]
+
+        # Rating buckets that are missing from a partition have no market value there
+        return pd.concat(results, sort=False).fillna({c: 0.0 for r in results for c in r.columns if c.startswith('rating_')})
+
+
 
 
 
@@ -82,4 +1238,4 @@ if __name__ == "__main__":
     idx = BlkEQIdx('Equity index', description='This is a dummy equity index')
     idx.print()
 
-    print()
\ No newline at end of file
+    print()
@@ -1,5 +1,13 @@
 import datetime
 import logging
+import numpy as np
+import pandas as pd
+
+# Number of months between two consecutive refixes
+_REFIX_MONTHS = {'MONTHLY': 1,
+                 'QUARTERLY': 3,
+                 'SEMIANNUAL': 6,
+                 'ANNUAL': 12}
 
 def create_date_series(start_date,
                        end_date,
@@ -21,6 +29,28 @@ def create_date_series(start_date,
     return ds.build_time_series()
 
 
+def governing_refix_dates(refix_dates, dates):
+    '''
+    Maps each date to the last refix date on or before it with a binary search
+    on the sorted refix dates.
+
+    :param refix_dates: refix dates
+    :param dates: dates to map
+    :return: series of refix dates indexed by dates, NaT for dates before the first refix
+    '''
+
+    refix_dates = pd.DatetimeIndex(refix_dates).sort_values()
+    dates = pd.DatetimeIndex(dates)
+
+    if not len(refix_dates):
+        return pd.Series(pd.NaT, index=dates, name='refix_date', dtype='datetime64[ns]')
+
+    positions = refix_dates.searchsorted(dates, side='right') - 1
+    governing = np.where(positions >= 0, refix_dates.values[np.maximum(positions, 0)], np.datetime64('NaT'))
+
+    return pd.Series(governing, index=dates, name='refix_date')
+
+
 class DatesSeries:
 
     'Sample class that creates historical index for performance testing'
@@ -71,3 +101,48 @@ class DatesSeries:
 
         return  date_list
 
+
+    def build_refix_dates(self):
+        '''
+        Builds the refix dates from first_refix, or start_date if it is not set,
+        until end_date using refix_frequency.
+
+        :return: list of refix dates
+        '''
+
+        if self.refix_frequency not in _REFIX_MONTHS:
+            raise ValueError('refix_frequency must be one of %s' % list(_REFIX_MONTHS.keys()))
+
+        if self.first_refix is None:
+            first_refix = pd.Timestamp(self.start_date)
+        else:
+            first_refix = pd.Timestamp(self.first_refix)
+
+        # Each refix is built from the first one, so that month ends stay month ends
+        months = _REFIX_MONTHS[self.refix_frequency]
+        end_date = pd.Timestamp(self.end_date)
+        month_end = first_refix.is_month_end
+
+        refix_dates = []
+        refix_date = first_refix
+        while refix_date <= end_date:
+            refix_dates.append(refix_date)
+            refix_date = first_refix + pd.DateOffset(months=len(refix_dates) * months)
+            if month_end:
+                refix_date = refix_date + pd.offsets.MonthEnd(0)
+
+        logging.debug(str(refix_dates))
+
+        return refix_dates
+
+
+    def refix_periods(self, dates):
+        '''
+        Maps each date to the refix that governs it.
+
+        :param dates: dates to map
+        :return: series of refix dates indexed by dates
+        '''
+
+        return governing_refix_dates(self.build_refix_dates(), dates)
+
@@ -2,28 +2,56 @@ import logging
 import sys
 import inspect
 import re
+import concurrent.futures
 from dill.source import getsource
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
 from blkbis import tstdata
+from blkbis import filters
 
 logger = logging.getLogger(__name__)
 
 
-def updateDateTypes(df):
+# Candidate date formats, tried in this order, with the regular expression their values must match
+_DATE_FORMATS = [('%Y-%m-%d', r'^[1-2]\d{3}-\d{2}-\d{2}'),
+                 ('%m/%d/%Y', r'^\d{2}\/\d{2}\/[1-2]\d{3}'),
+                 ('%Y%m%d', r'^[1-2]\d{3}\d{2}\d{2}')]
+
+# Date format chosen for each (column name, column type)
+_DATE_FORMAT_CACHE = {}
+
+
+def clear_date_format_cache():
+    _DATE_FORMAT_CACHE.clear()
+
+
+def updateDateTypes(df, sample_size=100, use_cache=True, n_threads=1):
     '''
     Takes a pandas dateframe and update columns that look like datetimes.
 
     :param df: input dataframe
+    :param sample_size: number of values of each column used to pick the format
+    :param use_cache: whether to reuse the formats picked for the same column name and type in previous calls
+    :param n_threads: number of columns converted in parallel
     :return: None
     '''
 
-    for c in df.columns:
-        guessDateTypes(df, c)
+    columns = list(df.columns)
+
+    if n_threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            converted = list(executor.map(lambda c: _convertDates(df[c], c, sample_size, use_cache), columns))
+    else:
+        converted = [_convertDates(df[c], c, sample_size, use_cache) for c in columns]
 
+    for c, values in zip(columns, converted):
+        if values is not None:
+            df[c] = values
 
-def guessDateTypes(df, c):
+
+def guessDateTypes(df, c, sample_size=100, use_cache=True):
     '''
     Takes a pandas dataframe and column c and updates its type to datetime if possible.
 
@@ -31,38 +59,79 @@ def guessDateTypes(df, c):
     :return: None
     '''
 
-    formats = {'%Y-%m-%d': '^[1-2]\d{3}-\d{2}-\d{2}',
-               '%m/%d/%Y': '^\d{2}\/\d{2}\/[1-2]\d{3}',
-               '%Y%m%d': '^[1-2]\d{3}\d{2}\d{2}'
-    }
+    values = _convertDates(df[c], c, sample_size, use_cache)
+    if values is not None:
+        df[c] = values
+
+
+def _sampleFormats(s, sample_size):
+    '''
+    :return: the formats whose regular expression matches all the values of a sample of s
+    '''
+
+    positions = np.unique(np.linspace(0, len(s) - 1, min(sample_size, len(s))).astype(int))
+    sample = s.iloc[positions].astype(str)
+
+    return [format for format, regexp in _DATE_FORMATS if sample.str.contains(regexp).all()]
 
-    # For this format to work we need to make sure that the format matches
-    # as integers will convert just fine
 
-    for format, regexp in formats.items():
+def _convertDates(s, c, sample_size=100, use_cache=True):
+    '''
+    Converts a column to datetime if its values look like dates.
+
+    The candidate formats are first checked on a sample of the column, and only the
+    retained formats are tried, in order, on the whole column with pd.to_datetime. As
+    before, a column with missing values is not converted. The chosen format is cached
+    by column name and type, and tried first on the next loads. Columns that are not
+    dates are not cached, the sample check being cheap.
+
+    :param s: column
+    :param c: name of the column
+    :return: the converted column, None if it is not converted
+    '''
+
+    if pd.api.types.is_datetime64_any_dtype(s) or not len(s) or s.isnull().any():
+        return None
+
+    key = (c, str(s.dtype))
+
+    if use_cache and key in _DATE_FORMAT_CACHE:
+        candidates = [_DATE_FORMAT_CACHE[key]]
+    else:
+        candidates = _sampleFormats(s, sample_size)
+
+    for format in candidates:
         logger.debug('Trying to convert column "%s" to datetime using format %s', c, format)
-        if False not in df[c].astype(str).str.contains(regexp).tolist():
-            try:
-                df[c] = pd.to_datetime(df[c], format=format)
-            except:
-                logger.debug('Type conversion failed')
-            else:
-                logger.debug('>>> Converted column %s to datetime using format %s', c, format)
-                return
+        try:
+            values = pd.to_datetime(s, format=format)
+        except Exception:
+            logger.debug('Type conversion failed')
         else:
-            logger.debug('Format %s does not match values' % (format))
+            logger.debug('>>> Converted column %s to datetime using format %s', c, format)
+            _DATE_FORMAT_CACHE[key] = format
+            return values
+
+    if use_cache and key in _DATE_FORMAT_CACHE:
+        # The cached format does not fit anymore: the formats are inferred again
+        del _DATE_FORMAT_CACHE[key]
+        return _convertDates(s, c, sample_size, use_cache)
+
+    return None
 
 
 
 
 
-def filterOnColumn(df, column, condition, result_column, condition_column, inplace=True, **kwargs):
+def filterOnColumn(df, column, condition, result_column, condition_column, inplace=True, registry=None, **kwargs):
     '''
 
     :param df: input pandas dataframe
     :param column: column that is the target of the filtering
     :param condition:
+    :param condition_column: bitset column of the conditions passed by each row, whose source and
+        description are stored once in the registry
     :param inplace: inplace condition
+    :param registry: filters.FilterRegistry, rebuilt from the frame metadata, see filters.get_registry, if None
     :return: the new dataframe if inplace is True, otherwise None
     '''
 
@@ -85,8 +154,15 @@ def filterOnColumn(df, column, condition, result_column, condition_column, inpla
     logger.debug('Retained filter_source')
     logger.debug(filter_source)
 
+    if registry is None:
+        registry = filters.get_registry(df)
+
     df[result_column] = df[column].apply(condition)
-    df[condition_column] = getsource(condition)
+
+    filter_id = registry.register(condition, kwargs.get('description', filter_source), column, filter_source)
+    registry.mark(df, filter_id, df[result_column].values, condition_column)
+
+    registry.attach(df)
 
     if not inplace:
         return df
@@ -1,5 +1,10 @@
 import pandas as pd
+import numpy as np
+import abc
 import inspect
+import json
+import threading
+import concurrent.futures
 
 '''
 The DFFilter class. It is used primarily for two purposes:
@@ -13,14 +18,296 @@ A filter is essentially a function that is applied to the dataframe, enriched  w
 a description of what it does to help keep track of all the processing that went into
 building the dataset.
 
+A filter function can be element-wise, called once per value, or vectorized, called
+once per column with the whole Series and returning a boolean mask, e.g. lambda x: x >= 2
+works both ways. The mode is given with the vectorized argument, or detected on the
+first column the filter is applied to.
+
+Filters compose with &, | and ~ into a lazy expression, e.g. (f1 & ~f2) | f3. The
+expression is only evaluated when its mask is requested, into a single boolean mask:
+the right operand of & is only evaluated on the rows where the left one is True, and
+the right operand of | on the rows where it is False. The columns of each filter are
+given with the columns argument, the columns of the call being used otherwise.
+
+The provenance of the filtered data is kept in a FilterRegistry: each filter applied to
+a column gets a small integer id, and its description and source are stored once. The
+registry is passed from call to call, and its entries are copied to the frame metadata
+(df.attrs['filter_provenance']) as plain JSON data, so that the frame can still be saved
+to parquet or pickled. The registry can also be saved to a sidecar file. Each row only
+carries an integer bitset of the filters it passed.
+
 LB
 
 '''
 
 
-class DFFilter():
+# Number of values used to check that a function gives the same results vectorized and element-wise
+_DETECTION_SAMPLE_SIZE = 100
+
+# Key of the registry entries in the frame metadata, and default name of the bitset column
+_PROVENANCE_ATTR = 'filter_provenance'
+_PROVENANCE_COLUMN = '_filter_provenance'
+
+# Smallest unsigned integer types that hold the bitsets, by number of bits
+_BITSET_TYPES = [(8, np.uint8), (16, np.uint16), (32, np.uint32), (64, np.uint64)]
+
+
+def function_source(function):
+    '''
+    :return: the source of function, its representation if the source is not available
+    '''
+
+    try:
+        return str(inspect.getsource(function))
+    except (OSError, TypeError):
+        return repr(function)
+
+
+
+
+class FilterRegistry():
+    '''
+    Registry of the filters applied to a dataset, up to 64. Each (function, column)
+    is registered once with a small integer id, which is the position of its bit in
+    the provenance bitsets of the rows.
+
+    The entries (id, description, column and source) are plain data. The functions are
+    only known to the registry object: a registry rebuilt from entries, e.g. from the
+    frame metadata or a sidecar file, recognizes a filter by its description, column
+    and source.
+    '''
+
+    def __init__(self, entries=None):
+        '''
+        :param entries: entries of a previous registry
+        '''
+
+        self.entries = [dict(e) for e in entries] if entries is not None else []
+        self.__ids__ = {}
+
+
+    def register(self, function, description, column=None, source=None):
+        '''
+        :param function: filter function, used with column to recognize filters applied again
+        :param description: description of the filter
+        :param column: column the filter was applied to
+        :param source: source of the filter, function_source(function) if None
+        :return: id of the filter
+        '''
+
+        key = (function, column)
+        if key in self.__ids__:
+            return self.__ids__[key]
+
+        if source is None:
+            source = function_source(function)
+
+        for entry in self.entries:
+            if (entry['description'], entry['column'], entry['source']) == (description, column, source):
+                self.__ids__[key] = entry['id']
+                return entry['id']
+
+        if len(self.entries) == _BITSET_TYPES[-1][0]:
+            raise ValueError('A registry holds at most %d filters' % _BITSET_TYPES[-1][0])
+
+        self.__ids__[key] = len(self.entries)
+        self.entries.append({'id': len(self.entries),
+                             'description': description,
+                             'column': column,
+                             'source': source})
+
+        return self.__ids__[key]
+
+
+    def mark(self, df, filter_id, passed, column=None):
+        '''
+        Sets the bit of a filter in the bitsets of the rows that passed it.
+
+        :param df: dataframe, updated in place
+        :param filter_id: id returned by register
+        :param passed: boolean mask of the rows of df that passed the filter
+        :param column: bitset column, _PROVENANCE_COLUMN if None
+        '''
+
+        if column is None:
+            column = _PROVENANCE_COLUMN
+
+        dtype = [t for bits, t in _BITSET_TYPES if filter_id < bits][0]
+        if column in df.columns:
+            bitsets = df[column].values
+            if np.dtype(bitsets.dtype).itemsize < np.dtype(dtype).itemsize:
+                bitsets = bitsets.astype(dtype)
+            else:
+                dtype = bitsets.dtype
+        else:
+            bitsets = np.zeros(len(df), dtype=dtype)
+
+        dtype = np.dtype(dtype)
+        bit = np.asarray(passed, dtype=bool).astype(dtype) << dtype.type(filter_id)
+        df[column] = bitsets | bit
+
+
+    def passed(self, bitsets, filter_id):
+        '''
+        :param bitsets: Series or array of bitsets
+        :return: boolean mask of the rows that passed the filter
+        '''
+
+        bitsets = np.asarray(bitsets)
+        return (bitsets >> bitsets.dtype.type(filter_id)) & 1 == 1
+
+
+    def to_frame(self):
+        return pd.DataFrame(self.entries, columns=['id', 'description', 'column', 'source']).set_index('id')
+
+
+    def attach(self, df):
+        '''
+        Copies the entries to the metadata of df.
+        '''
+
+        df.attrs[_PROVENANCE_ATTR] = [dict(e) for e in self.entries]
+
+
+    def save(self, path):
+        '''
+        Saves the entries to a JSON sidecar file.
+        '''
+
+        with open(path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads the entries saved by save.
+        '''
+
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+
+
+def get_registry(df):
+    '''
+    :return: a FilterRegistry rebuilt from the entries in the metadata of df, empty if there are none
+    '''
+
+    return FilterRegistry(df.attrs.get(_PROVENANCE_ATTR))
+
+
+class FilterExpression(abc.ABC):
+    '''
+    Base class of the filters and of their combinations. Subclasses implement _evaluate.
+    '''
+
+    def __and__(self, other):
+        return CompositeFilter('&', [self, other])
+
+
+    def __or__(self, other):
+        return CompositeFilter('|', [self, other])
+
+
+    def __invert__(self):
+        return CompositeFilter('~', [self])
+
+
+    @abc.abstractmethod
+    def _evaluate(self, df, columns, rows):
+        '''
+        :param df: dataframe
+        :param columns: columns of the call
+        :param rows: positions of the rows to evaluate
+        :return: boolean array, one value per row of rows
+        '''
+
+
+    def mask(self, df, columns=None):
+        '''
+        Evaluates the expression.
+
+        :param df: dataframe
+        :param columns: columns of the filters that do not have their own, all the columns if None
+        :return: boolean Series with the index of df, True for the rows that pass
+        '''
+
+        if not columns:
+            columns = df.columns
+
+        return pd.Series(self._evaluate(df, list(columns), np.arange(len(df))), index=df.index)
+
+
+    def __call__(self, df, columns=None):
+        '''
+        :return: a copy of the rows of df that pass the expression
+        '''
+
+        return df[self.mask(df, columns).values]
+
+
+
+
+class CompositeFilter(FilterExpression):
+    '''
+    Combination of filters with &, | or ~. Nested combinations with the same operator are
+    flattened into one node.
+    '''
 
-    def __init__(self, function=None, description=None):
+    def __init__(self, op, operands):
+
+        self.op = op
+        self.operands = []
+        for operand in operands:
+            if op != '~' and isinstance(operand, CompositeFilter) and operand.op == op:
+                self.operands.extend(operand.operands)
+            else:
+                self.operands.append(operand)
+
+        if op == '~':
+            self.description = '~(' + self.operands[0].description + ')'
+        else:
+            self.description = (' ' + op + ' ').join('(' + o.description + ')' for o in self.operands)
+
+
+    def __str__(self):
+        return self.description
+
+
+    def _evaluate(self, df, columns, rows):
+
+        if self.op == '~':
+            return ~self.operands[0]._evaluate(df, columns, rows)
+
+        # Rows whose result is still undecided: True for &, False for |
+        undecided = True if self.op == '&' else False
+        result = np.full(len(rows), undecided)
+        alive = np.arange(len(rows))
+
+        for operand in self.operands:
+            if not len(alive):
+                break
+            mask = operand._evaluate(df, columns, rows[alive])
+            result[alive] = mask
+            alive = alive[mask == undecided]
+
+        return result
+
+
+
+
+class DFFilter(FilterExpression):
+
+    def __init__(self, function=None, description=None, vectorized=None, columns=None):
+        '''
+        :param function: function of a value, or of a Series when vectorized, that returns True for the values to keep
+        :param description: description of the filter
+        :param vectorized: True if function takes a Series and returns a boolean mask, False if it
+            takes a single value, None to detect it for each column type
+        :param columns: columns the filter applies to in expressions, the columns of the call if None
+        '''
 
         if function is None:
             raise ValueError('"function" must be set')
@@ -32,6 +319,70 @@ class DFFilter():
         else:
             self.description = description
 
+        self.vectorized = vectorized
+        self.columns = list(columns) if columns is not None else None
+        self.offenders = {}
+        self.__modes__ = {}
+
+
+    def _is_vectorized(self, s):
+        '''
+        Whether the function can be applied on the whole Series s. When not explicitly set,
+        the function is called on a sample of s and its result is compared with the
+        element-wise results. The decision is kept for the type of the Series.
+        '''
+
+        if self.vectorized is not None:
+            return self.vectorized
+
+        if s.dtype not in self.__modes__:
+            sample = s.iloc[:_DETECTION_SAMPLE_SIZE]
+            try:
+                mask = np.asarray(self.function(sample))
+                vectorized = (mask.dtype == bool and mask.shape == (len(sample),) and
+                              np.array_equal(mask, np.asarray(sample.apply(self.function), dtype=bool)))
+            except Exception:
+                vectorized = False
+            self.__modes__[s.dtype] = vectorized
+
+        return self.__modes__[s.dtype]
+
+
+    def evaluate(self, s):
+        '''
+        Applies the function to all the values of a Series.
+
+        :param s: Series
+        :return: Series of the results, with the index of s
+        '''
+
+        if self._is_vectorized(s):
+            return pd.Series(np.asarray(self.function(s), dtype=bool), index=s.index)
+
+        return s.apply(self.function)
+
+
+    def _evaluate(self, df, columns, rows):
+        '''
+        A row passes if the values of all the columns pass, the next column being only
+        evaluated on the rows that passed so far.
+        '''
+
+        if self.columns is not None:
+            columns = self.columns
+
+        result = np.ones(len(rows), dtype=bool)
+        alive = np.arange(len(rows))
+
+        for c in columns:
+            if not len(alive):
+                break
+            s = df[c] if len(alive) == len(df) else df[c].iloc[rows[alive]]
+            result[alive] = np.asarray(self.evaluate(s), dtype=bool)
+            alive = alive[result[alive]]
+
+        return result
+
 
     def __str__(self):
         '''
@@ -44,13 +395,17 @@ class DFFilter():
 
 
     def filter_columns(self, df, columns=None, inplace=False, add_function_description=False, filter_results=False,
-                       function_ext=None, results_ext=None):
+                       function_ext=None, results_ext=None, registry=None):
         '''
         Uses the function that defines the filter and applies it on the list of
         columns to remove all values that do not match.
 
         :param df:
         :param columns:
+        :param add_function_description: whether to record the filter in the registry, and the rows that
+            passed it in the _filter_provenance bitset column
+        :param function_ext: not used anymore, the description is in the registry
+        :param registry: FilterRegistry, rebuilt from the frame metadata, see get_registry, if None
         :return:
         '''
 
@@ -60,22 +415,28 @@ class DFFilter():
         if not results_ext:
             results_ext = '_filter_result'
 
-        if not function_ext:
-            function_ext = '_filter_function'
-
         if inplace:
             df0 = df
         else:
             df0 = df.copy(deep=True)
 
+        if add_function_description:
+            if registry is None:
+                registry = get_registry(df0)
+            source = function_source(self.function)
+
         for c in columns:
-            df0[c + results_ext] = df[c].apply(self.function)
+            df0[c + results_ext] = self.evaluate(df0[c])
+
+            if add_function_description:
+                filter_id = registry.register(self.function, self.description, c, source)
+                registry.mark(df0, filter_id, df0[c + results_ext].values)
 
             if filter_results:
                 df0 = df0[df0[c + results_ext]]
 
-            if add_function_description:
-                df0[c + function_ext] = str(inspect.getsource(self.function))
+        if add_function_description:
+            registry.attach(df0)
 
         if not inplace:
             return df0
@@ -83,22 +444,85 @@ class DFFilter():
 
 
 
-    def check_columns(self, df, columns=None, abort_if_test_fails=True):
+    def _check_column(self, s, chunk_size, n_offenders, stop):
+        '''
+        Evaluates a column chunk by chunk, until a chunk fails or, when collecting
+        offenders, until n_offenders are found.
+
+        :return: (passed, index labels of the offending rows found)
+        '''
+
+        offenders = []
+        passed = True
+
+        for start in range(0, len(s), chunk_size):
+            if stop.is_set():
+                break
+
+            failed = np.flatnonzero(~np.asarray(self.evaluate(s.iloc[start:start + chunk_size]), dtype=bool))
+            if len(failed):
+                passed = False
+                offenders.extend(s.index[start + failed[:n_offenders - len(offenders)]])
+                if len(offenders) >= n_offenders:
+                    break
+
+        return passed, offenders
+
+
+    def check_columns(self, df, columns=None, abort_if_test_fails=True, chunk_size=100000, n_offenders=0, n_threads=1):
         '''
         Uses the function that defines the filter and applies it on the list of
         columns to check if all values verify the condition.
 
+        The columns are evaluated in chunks of chunk_size rows, and the check stops at the
+        first failing chunk. With n_offenders > 0, the evaluation of each column goes on
+        until n_offenders offending rows are found, and their index labels are kept in
+        the offenders attribute, by column. With n_threads > 1, the columns are checked in
+        parallel threads, which helps with vectorized functions that release the GIL.
+
         :param df:
         :param columns:
+        :param abort_if_test_fails: whether to raise a ValueError when the check fails
+        :param chunk_size: number of rows evaluated at once
+        :param n_offenders: number of offending rows to collect for each column
+        :param n_threads: number of threads
         :return: True or False
         '''
 
         if not columns:
             columns = df.columns
 
-        for c in columns:
-            if False in df[c].apply(self.function):
-                raise ValueError('Dataframe contains values that do not satisfy the condition')
+        # Once a column fails, the other columns stop, unless offenders are collected
+        stop = threading.Event()
+
+        def check(c):
+            passed, offenders = self._check_column(df[c], chunk_size, n_offenders, stop)
+            if not passed and n_offenders == 0:
+                stop.set()
+            return passed, offenders
+
+        if n_threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+                results = list(executor.map(check, columns))
+        else:
+            results = []
+            for c in columns:
+                results.append(check(c))
+                if not results[-1][0] and n_offenders == 0:
+                    break
+
+        self.offenders = dict((c, r[1]) for c, r in zip(columns, results) if r[1])
+        failed = [c for c, r in zip(columns, results) if not r[0]]
+
+        if failed:
+            if abort_if_test_fails:
+                message = 'Dataframe contains values that do not satisfy the condition in column(s) ' + ', '.join(str(c) for c in failed)
+                if self.offenders:
+                    message += ', first offending rows: ' + str(self.offenders)
+                raise ValueError(message)
+            return False
+
+        return True
 
 
 
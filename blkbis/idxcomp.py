@@ -2,4 +2,349 @@
 
 Utilities and classes to compare two indices.
 
-'''
\ No newline at end of file
+'''
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+from blkbis import blkidx
+
+logger = logging.getLogger(__name__)
+
+
+# Status of a (date, id) pair in the comparison
+_BOTH = 'BOTH'
+_LEFT_ONLY = 'LEFT_ONLY'
+_RIGHT_ONLY = 'RIGHT_ONLY'
+
+# Files of the comparison cache
+_CACHE_FILES = ['settings', 'fingerprints', 'constituents', 'summary', 'sector_exposures', 'returns']
+
+
+def _aggregate_weights(weights):
+    '''
+    Makes (date, id) unique on one side of the comparison, summing the weights.
+    '''
+
+    agg = {'weight': 'sum'}
+    if 'sector' in weights.columns:
+        agg['sector'] = 'first'
+
+    return weights.groupby(['date', 'id'], as_index=False, observed=True, sort=False).agg(agg)
+
+
+def sorted_outer_join(left, right, dates):
+    '''
+    Outer joins two weight frames on (date, id) without hashing the rows.
+
+    Each (date, id) pair is packed into a single int64 key made of the position of the
+    date and the code of the id in a sorted dictionary shared by both sides, so that the
+    keys sort by (date, id). The keys of each side are sorted once, and the union of the
+    keys is matched back to each side with a binary search.
+
+    :param left: dataframe with date, id and weight, unique on (date, id)
+    :param right: dataframe with date, id and weight, unique on (date, id)
+    :param dates: sorted union of the dates of both sides
+    :return: dataframe with date, id, weight_left, weight_right and status, sorted by (date, id)
+    '''
+
+    codes, ids = pd.factorize(pd.concat([left['id'], right['id']], ignore_index=True).astype(object), sort=True)
+    n_ids = max(len(ids), 1)
+
+    def keys_of(df, id_codes):
+        positions = dates.get_indexer(pd.DatetimeIndex(df['date'])).astype(np.int64)
+        keys = positions * n_ids + id_codes
+        order = np.argsort(keys, kind='mergesort')
+        return keys[order], df['weight'].values[order]
+
+    left_keys, left_weights = keys_of(left, codes[:len(left)])
+    right_keys, right_weights = keys_of(right, codes[len(left):])
+
+    keys = np.union1d(left_keys, right_keys)
+
+    def match(side_keys, side_weights):
+        positions = np.minimum(np.searchsorted(side_keys, keys), max(len(side_keys) - 1, 0))
+        found = side_keys[positions] == keys if len(side_keys) else np.zeros(len(keys), dtype=bool)
+        weights = np.where(found, side_weights[positions] if len(side_keys) else 0.0, 0.0)
+        return found, weights
+
+    in_left, weight_left = match(left_keys, left_weights)
+    in_right, weight_right = match(right_keys, right_weights)
+
+    status = np.where(in_left & in_right, _BOTH, np.where(in_left, _LEFT_ONLY, _RIGHT_ONLY))
+
+    return pd.DataFrame({'date': dates.values[keys // n_ids],
+                         'id': np.asarray(ids, dtype=object)[keys % n_ids],
+                         'weight_left': weight_left,
+                         'weight_right': weight_right,
+                         'weight_diff': weight_right - weight_left,
+                         'status': status},
+                        columns=['date', 'id', 'weight_left', 'weight_right', 'weight_diff', 'status'])
+
+
+class IdxComparison:
+    '''
+    Compares two indices, typically a production build (left) and a candidate
+    build (right), over all their dates at once.
+
+    The results are:
+
+    - constituents: one row per (date, id) with the weights on each side and whether
+      the id is in both indices, only in the left one (drop) or only in the right one (add)
+    - summary: counts of common constituents, adds and drops, and the active share by date
+    - sector_exposures: the weight of each sector on each side by date
+    - returns: the return of each index, the active return and the tracking error by date
+
+    When a cache directory is given, the fingerprints of the date blocks of both
+    indices are saved with the results, and later runs only recompute the dates
+    whose fingerprints changed, plus the dates whose returns depend on them.
+    '''
+
+    def __init__(self,
+                 left=None,
+                 right=None,
+                 weighting='CAP',
+                 size_column='size_mm',
+                 window=None,
+                 cache_dir=None,
+                 **kwargs):
+        '''
+        :param left: reference BlkIdx
+        :param right: BlkIdx compared with the reference
+        :param weighting: CAP or EQUAL, see blkidx.index_returns
+        :param size_column: column used for the weights and the constituent returns
+        :param window: number of dates of the rolling tracking error, expanding if None
+        :param cache_dir: optional directory where the results of the comparison are cached
+        :param kwargs:
+        '''
+
+        if left is None or right is None:
+            raise ValueError('left and right must be specified')
+
+        self.left = left
+        self.right = right
+        self.weighting = weighting
+        self.size_column = size_column
+        self.window = window
+        self.cache_dir = cache_dir
+
+
+    def _side(self, idx, dates=None):
+        '''
+        Computes the returns and the weights of one index, on all its dates or only on
+        the given dates.
+        '''
+
+        if dates is None:
+            df = idx.idxdata
+        else:
+            df = idx.select_dates(self._dates_to_read(idx.dates, dates))
+
+        returns, weights = blkidx.index_returns(df, idx.dates, self.weighting, self.size_column)
+
+        if dates is not None:
+            returns = returns[returns.index.isin(dates)]
+            weights = weights[weights['date'].isin(dates)]
+
+        return returns, _aggregate_weights(weights)
+
+
+    def compare(self):
+        '''
+        Runs the comparison, incrementally if a cache directory was given.
+
+        :return: self, with the constituents, summary, sector_exposures and returns attributes set
+        '''
+
+        if self.cache_dir is not None:
+            return self._compare_incremental()
+
+        left_returns, left_weights = self._side(self.left)
+        right_returns, right_weights = self._side(self.right)
+
+        dates = self.left.dates.union(self.right.dates)
+
+        self.constituents = sorted_outer_join(left_weights, right_weights, dates)
+        self.summary = self._summarize(self.constituents, dates)
+        self.sector_exposures = self._sector_exposures(left_weights, right_weights)
+        self.returns = self._returns(left_returns['index_return'], right_returns['index_return'], dates)
+
+        logger.debug('Compared %d dates and %d (date, id) pairs', len(dates), len(self.constituents))
+
+        return self
+
+
+    def _settings(self):
+        return {'weighting': self.weighting, 'size_column': self.size_column}
+
+
+    def _load_cache(self):
+        paths = [os.path.join(self.cache_dir, f + '.pkl') for f in _CACHE_FILES]
+        if not all(os.path.exists(p) for p in paths):
+            return None
+
+        cache = dict(zip(_CACHE_FILES, [pd.read_pickle(p) for p in paths]))
+        if cache['settings'] != self._settings():
+            logger.info('Comparison settings changed, ignoring the cache in %s', self.cache_dir)
+            return None
+
+        return cache
+
+
+    def _save_cache(self, fingerprints):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        cache = {'settings': self._settings(),
+                 'fingerprints': fingerprints,
+                 'constituents': self.constituents,
+                 'summary': self.summary,
+                 'sector_exposures': self.sector_exposures,
+                 'returns': self.returns}
+
+        for f in _CACHE_FILES:
+            pd.to_pickle(cache[f], os.path.join(self.cache_dir, f + '.pkl'))
+
+
+    @staticmethod
+    def _dates_to_read(idx_dates, dates):
+        '''
+        Returns the dates of one index needed to compute its returns on dates: the dates
+        themselves and the date of the index that precedes each of them.
+        '''
+
+        positions = idx_dates.searchsorted(dates, side='left') - 1
+        previous = idx_dates[positions[positions >= 0]]
+
+        return dates.union(previous)
+
+
+    @staticmethod
+    def _next_dates(idx_dates, dates):
+        positions = idx_dates.searchsorted(dates, side='right')
+        return idx_dates[positions[positions < len(idx_dates)]]
+
+
+    def _compare_incremental(self):
+
+        fingerprints = pd.DataFrame({'left': self.left.fingerprints(), 'right': self.right.fingerprints()},
+                                    columns=['left', 'right']).fillna('')
+        dates = fingerprints.index
+
+        cache = self._load_cache()
+
+        if cache is None:
+            changed = dates
+        else:
+            previous = cache['fingerprints'].reindex(dates).fillna('')
+            changed = dates[((previous['left'] != fingerprints['left']) |
+                             (previous['right'] != fingerprints['right'])).values]
+
+            # Dates that disappeared from one index change the returns of the next date
+            removed = cache['fingerprints'].index.difference(dates)
+            changed = changed.union(removed)
+
+        # The returns of the date that follows a changed date in each index also change
+        recompute = changed.union(self._next_dates(self.left.dates, changed))
+        recompute = recompute.union(self._next_dates(self.right.dates, changed))
+        recompute = recompute.intersection(dates)
+
+        logger.info('%d dates changed out of %d, recomputing %d dates', len(changed), len(dates), len(recompute))
+
+        left_returns, left_weights = self._side(self.left, recompute)
+        right_returns, right_weights = self._side(self.right, recompute)
+
+        constituents = sorted_outer_join(left_weights, right_weights, dates)
+        summary = self._summarize(constituents, dates).reindex(recompute)
+        sector_exposures = self._sector_exposures(left_weights, right_weights)
+        returns = pd.DataFrame({'return_left': left_returns['index_return'].reindex(recompute),
+                                'return_right': right_returns['index_return'].reindex(recompute)},
+                               columns=['return_left', 'return_right'])
+
+        if cache is not None:
+            constituents = pd.concat([cache['constituents'][~cache['constituents']['date'].isin(recompute) &
+                                                            cache['constituents']['date'].isin(dates)],
+                                      constituents], ignore_index=True)
+            constituents = constituents.sort_values(['date', 'id'], kind='mergesort').reset_index(drop=True)
+
+            summary = self._merge_by_date(cache['summary'], summary, recompute, dates)
+            returns = self._merge_by_date(cache['returns'][['return_left', 'return_right']], returns, recompute, dates)
+
+            if sector_exposures is not None and cache['sector_exposures'] is not None:
+                sector_exposures = self._merge_by_date(cache['sector_exposures'], sector_exposures, recompute, dates)
+
+        self.constituents = constituents
+        self.summary = summary
+        self.sector_exposures = sector_exposures
+        self.returns = self._returns(returns['return_left'], returns['return_right'], dates)
+
+        self._save_cache(fingerprints)
+
+        return self
+
+
+    @staticmethod
+    def _merge_by_date(cached, recomputed, recompute, dates):
+        cached_dates = cached.index.get_level_values(0)
+        cached = cached[~cached_dates.isin(recompute) & cached_dates.isin(dates)]
+
+        return pd.concat([cached, recomputed]).sort_index()
+
+
+    @staticmethod
+    def _summarize(constituents, dates):
+        positions = dates.get_indexer(pd.DatetimeIndex(constituents['date']))
+        status = constituents['status'].values
+
+        def count(mask):
+            return np.bincount(positions[mask], minlength=len(dates))
+
+        return pd.DataFrame({'n_left': count(status != _RIGHT_ONLY),
+                             'n_right': count(status != _LEFT_ONLY),
+                             'n_common': count(status == _BOTH),
+                             'adds': count(status == _RIGHT_ONLY),
+                             'drops': count(status == _LEFT_ONLY),
+                             'active_share': 0.5 * np.bincount(positions, weights=np.abs(constituents['weight_diff'].values),
+                                                               minlength=len(dates))},
+                            index=dates,
+                            columns=['n_left', 'n_right', 'n_common', 'adds', 'drops', 'active_share'])
+
+
+    @staticmethod
+    def _sector_exposures(left_weights, right_weights):
+        if 'sector' not in left_weights.columns or 'sector' not in right_weights.columns:
+            return None
+
+        left = left_weights.groupby(['date', 'sector'], observed=True)['weight'].sum()
+        right = right_weights.groupby(['date', 'sector'], observed=True)['weight'].sum()
+
+        exposures = pd.DataFrame({'weight_left': left, 'weight_right': right}).fillna(0.0)
+        exposures['weight_diff'] = exposures['weight_right'] - exposures['weight_left']
+
+        return exposures
+
+
+    def _returns(self, left_returns, right_returns, dates):
+        returns = pd.DataFrame({'return_left': left_returns.reindex(dates),
+                                'return_right': right_returns.reindex(dates)},
+                               columns=['return_left', 'return_right'])
+        returns['active_return'] = returns['return_right'] - returns['return_left']
+
+        if self.window is None:
+            returns['tracking_error'] = returns['active_return'].expanding().std()
+        else:
+            returns['tracking_error'] = returns['active_return'].rolling(self.window).std()
+
+        return returns
+
+
+    def __str__(self):
+        s = 'Left index       = ' + self.left.name + '\n'
+        s += 'Right index      = ' + self.right.name + '\n'
+        if hasattr(self, 'summary'):
+            s += 'Summary: \n'
+            s += str(self.summary)
+
+        return s
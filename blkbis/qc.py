@@ -6,7 +6,14 @@ QC utilities
 
 import os
 import sys
+import json
+import time
+import uuid
+import sqlite3
 import logging
+import tempfile
+import tracemalloc
+import concurrent.futures
 import pandas as pd
 import numpy as np
 import logging
@@ -57,83 +64,1359 @@ def __init__():
     logger.debug('')
 
 
-def full_qc(idx):
+# Panel shared with the worker processes of full_qc, loaded once per process
+_SHARED_PANEL = None
+
+
+def default_suite():
+    '''
+    :return: list of the checks run by full_qc when no suite is given
+    '''
+
+    return [HistoricalPanelQCCheck(id='COVERAGE', description='Ids entering and dropping out of the panel'),
+            ValueQCCkeck(id='KEYS', description='Missing dates and ids',
+                         rules=[{'name': 'date_not_null', 'type': 'not_null', 'column': 'date'},
+                                {'name': 'id_not_null', 'type': 'not_null', 'column': 'id'}])]
+
+
+def _write_shared_panel(df, path):
+    '''
+    Writes the panel once to an Arrow IPC file, which the workers memory-map.
+    '''
+
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _load_shared_panel(path):
+    '''
+    Worker initializer: maps the Arrow file in memory. The buffers are shared with the
+    other workers through the page cache, and numeric columns without missing values
+    are not copied when converted to pandas.
+    '''
+
+    import pyarrow as pa
+
+    global _SHARED_PANEL
+    _SHARED_PANEL = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().to_pandas(split_blocks=True)
+
+
+def _run_check(check, df=None):
+    '''
+    Runs one check, on the shared panel if no dataframe is given.
+
+    :return: (QCResult, wall time in seconds, peak memory allocated by the check in bytes)
+    '''
+
+    if df is None:
+        df = _SHARED_PANEL
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = check.run_check(df)
+    finally:
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, wall_time, peak_memory
+
+
+def full_qc(idx, checks=None, n_jobs=None, tmp_dir=None):
+    '''
+    Runs a suite of independent checks over the panel of an index.
+
+    With n_jobs > 1, the checks run concurrently in a process pool. The panel is not
+    pickled for each check: it is written once to an Arrow file that each worker maps
+    in memory when it starts. The peak memory of a check is the peak of the memory
+    allocated through Python and numpy while it runs, as traced by tracemalloc.
+
+    :param idx: BlkIdx
+    :param checks: list of QCCheck objects with distinct ids, default_suite() if None
+    :param n_jobs: number of processes, all the cores of the machine if None, in process if 1
+    :param tmp_dir: directory of the shared panel file, the system temporary directory if None
+    :return: QCResult with one summary row per check, the checks that did not pass as flagged
+        rows, and the QCResult of each check in details['results']
+    '''
+
     logger.debug('Running full QC')
 
+    if checks is None:
+        checks = default_suite()
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(checks)))
+
+    start = time.perf_counter()
+    df = idx.idxdata
+
+    if n_jobs == 1:
+        outcomes = [_run_check(check, df) for check in checks]
+    else:
+        fd, path = tempfile.mkstemp(suffix='.arrow', dir=tmp_dir)
+        os.close(fd)
+        try:
+            _write_shared_panel(df, path)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,
+                                                        initializer=_load_shared_panel,
+                                                        initargs=(path,)) as executor:
+                futures = [executor.submit(_run_check, check) for check in checks]
+                outcomes = [f.result() for f in futures]
+        finally:
+            os.remove(path)
+
+    results = dict((check.id, outcome[0]) for check, outcome in zip(checks, outcomes))
+
+    summary = pd.DataFrame({'type': [check.__type__ for check in checks],
+                            'passed': [outcome[0].passed for outcome in outcomes],
+                            'n_flagged': [len(outcome[0].flagged) for outcome in outcomes],
+                            'wall_time': [outcome[1] for outcome in outcomes],
+                            'peak_memory_mb': [outcome[2] / 2.0 ** 20 for outcome in outcomes]},
+                           index=pd.Index([check.id for check in checks], name='check'),
+                           columns=['type', 'passed', 'n_flagged', 'wall_time', 'peak_memory_mb'])
+
+    metadata = {'description': 'Full QC of ' + str(idx.name),
+                'id': 'FULL_QC',
+                'type': 'SUITE',
+                'type_description': 'This runs a suite of independent checks'}
+
+    return QCResult(metadata=metadata,
+                    summary=summary,
+                    flagged=summary[~summary['passed']],
+                    timings={'total': time.perf_counter() - start},
+                    details={'results': results})
+
+
+
+
+class QCResult:
+    '''
+    Results of a QC check.
+
+    - metadata: the items of __QCCHECK_METADATA_ITEMS__ for the check that was run
+    - summary: dataframe of summary counts
+    - flagged: dataframe of the rows flagged by the check
+    - timings: seconds spent in each step of the check
+    - details: check specific results, e.g. the violating rows of each rule
+
+    Nothing is formatted when the check runs. Reports are rendered on demand,
+    one page of flagged rows at a time.
+    '''
+
+    def __init__(self,
+                 metadata=None,
+                 summary=None,
+                 flagged=None,
+                 timings=None,
+                 details=None,
+                 **kwargs):
+
+        self.metadata = metadata if metadata is not None else {}
+        self.summary = summary
+        self.flagged = flagged if flagged is not None else pd.DataFrame()
+        self.timings = timings if timings is not None else {}
+        self.details = details if details is not None else {}
+
+
+    @property
+    def passed(self):
+        return len(self.flagged) == 0
+
+
+    def n_pages(self, page_size=50):
+        return max(1, -(-len(self.flagged) // page_size))
+
+
+    def render(self, page=0, page_size=50, tablefmt='psql'):
+        '''
+        Renders one page of the flagged rows.
+
+        :param page: page number, starting at 0
+        :param page_size: number of rows per page
+        :param tablefmt: tabulate table format
+        :return: string
+        '''
+
+        rows = self.flagged.iloc[page * page_size:(page + 1) * page_size]
+        s = 'Flagged rows, page %d of %d\n' % (page + 1, self.n_pages(page_size))
+        s += tabulate(rows, headers='keys', tablefmt=tablefmt)
+
+        return s
+
+
+    def pages(self, page_size=50, tablefmt='psql'):
+        '''
+        Generates the pages of the flagged rows one by one.
+        '''
+
+        for page in range(self.n_pages(page_size)):
+            yield self.render(page, page_size, tablefmt)
+
+
+    def report(self, max_pages=1, page_size=50, tablefmt='psql'):
+        '''
+        Renders the metadata, the summary and the first pages of the flagged rows.
+
+        :param max_pages: number of pages of flagged rows, None for all of them
+        :return: string
+        '''
+
+        s = str(self) + '\n'
+        if self.summary is not None:
+            s += tabulate(self.summary, headers='keys', tablefmt=tablefmt) + '\n'
+
+        for page, text in enumerate(self.pages(page_size, tablefmt)):
+            if max_pages is not None and page >= max_pages:
+                break
+            s += text + '\n'
+
+        return s
+
+
+    # Overloads the print statement, without the data
+    def __str__(self):
+        s = ''
+        for item in __QCCHECK_METADATA_ITEMS__:
+            s += '%-17s= %s\n' % (item.capitalize().replace('_', ' '), self.metadata.get(item))
+        s += 'Flagged rows     = ' + str(len(self.flagged)) + '\n'
+        s += 'Timings (s)      = ' + ', '.join('%s: %.3f' % (k, v) for k, v in self.timings.items()) + '\n'
+
+        return s
+
+
+
+
+# Series derived from each field by the time series checks
+_TS_SERIES = ['level', 'change_abs', 'change_rel']
+
+
+def _ts_series_name(field, kind):
+    return field if kind == 'level' else field + '_' + kind
+
+
+def _finite(values):
+    '''
+    :return: values with the infinite values, e.g. relative changes from a zero level, set to NaN
+    '''
+
+    return np.where(np.isfinite(values), values, np.nan)
+
+
+def _group_starts(codes):
+    '''
+    :param codes: sorted integer codes of the ids
+    :return: for each row, the position of the first row with the same code
+    '''
+
+    return np.searchsorted(codes, codes, side='left')
+
+
+def rolling_prior_stats(values, codes, window, min_periods=2):
+    '''
+    Computes, for each row and each column of values, the mean and the standard
+    deviation (ddof=0) of the window previous rows of the same id, the row itself
+    excluded. All the ids are processed at once with cumulative sums that restart
+    at each id, on values centered on the mean of the id to limit the loss of
+    precision.
+
+    :param values: 2-d array of values, rows sorted by (id, date)
+    :param codes: sorted integer codes of the ids of the rows
+    :param window: number of previous rows
+    :param min_periods: minimum number of known values to compute the statistics
+    :return: the means and the standard deviations, with the shape of values
+    '''
+
+    known = ~np.isnan(values)
+    center = pd.DataFrame(values).groupby(codes).transform('mean').fillna(0.0).values
+    x = np.where(known, values - center, 0.0)
+
+    k = values.shape[1]
+    sums = pd.DataFrame(np.hstack([x, x * x, known.astype(float)])).groupby(codes).cumsum().values
+
+    rows = np.arange(len(values))
+    starts = _group_starts(codes)
+    end = rows - 1
+    start = rows - window - 1
+
+    upper = np.where((end >= starts)[:, None], sums[np.maximum(end, 0)], 0.0)
+    lower = np.where((start >= starts)[:, None], sums[np.maximum(start, 0)], 0.0)
+    window_sums = upper - lower
+
+    s1, s2, n = window_sums[:, :k], window_sums[:, k:2 * k], window_sums[:, 2 * k:]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        std = np.sqrt(np.maximum(s2 / n - mean * mean, 0.0))
+
+    too_few = n < min_periods
+    mean[too_few] = np.nan
+    std[too_few] = np.nan
+
+    return mean + center, std
+
+
+def ewm_prior_stats(values, codes, positions, alpha, min_periods=2, state=None):
+    '''
+    Runs the exponentially weighted mean and variance recurrence
+
+        m_t = m_t-1 + alpha * (x_t - m_t-1)
+        v_t = (1 - alpha) * (v_t-1 + alpha * (x_t - m_t-1) ** 2)
+
+    date by date, vectorized over all the ids observed at each date and all the
+    columns of values. Missing values leave the state unchanged. The statistics
+    returned for a row are the ones before its value is included.
+
+    :param values: 2-d array of values, unique on (id, date)
+    :param codes: integer codes of the ids of the rows
+    :param positions: integer positions of the dates of the rows
+    :param alpha: smoothing factor
+    :param min_periods: minimum number of known values to return the statistics
+    :param state: optional dictionary of mean, var and count arrays of shape (number of ids, number of columns), updated in place
+    :return: the means, the standard deviations and the final state
+    '''
+
+    k = values.shape[1]
+    n_ids = codes.max() + 1 if len(codes) else 0
+
+    if state is None:
+        state = {'mean': np.zeros((n_ids, k)), 'var': np.zeros((n_ids, k)), 'count': np.zeros((n_ids, k))}
+
+    mean, var, count = state['mean'], state['var'], state['count']
+
+    prior_mean = np.full(values.shape, np.nan)
+    prior_std = np.full(values.shape, np.nan)
+
+    order = np.argsort(positions, kind='mergesort')
+    bounds = np.append(np.unique(positions[order], return_index=True)[1], len(order))
+
+    for i in range(len(bounds) - 1):
+        rows = order[bounds[i]:bounds[i + 1]]
+        c = codes[rows]
+        x = values[rows]
+        known = ~np.isnan(x)
+
+        enough = count[c] >= min_periods
+        prior_mean[rows] = np.where(enough, mean[c], np.nan)
+        prior_std[rows] = np.where(enough, np.sqrt(var[c]), np.nan)
+
+        first = count[c] == 0
+        delta = np.where(known, x - mean[c], 0.0)
+        mean[c] = np.where(known & first, x, np.where(known, mean[c] + alpha * delta, mean[c]))
+        var[c] = np.where(known & ~first, (1.0 - alpha) * (var[c] + alpha * delta * delta), var[c])
+        count[c] = count[c] + known
+
+    return prior_mean, prior_std, state
+
+
+# Scale that makes the median absolute deviation consistent with the standard
+# deviation of normally distributed values
+_MAD_SCALE = 1.4826
+
+
+def robust_cross_section(df, fields, by):
+    '''
+    Computes, within each group of by, the robust z-score (x - median) / (1.4826 * MAD)
+    and the percentile rank of each field. Everything is done with grouped transforms
+    over the whole frame.
+
+    :param df: dataframe with the by columns and the fields
+    :param fields: columns to score
+    :param by: list of columns that define the cross-sections, e.g. ['date'] or ['date', 'sector']
+    :return: dataframe with the same index as df and, for each field, the _median, _mad, _robust_z and _pct_rank columns
+    '''
+
+    keys = [df[c] for c in by]
+    scores = pd.DataFrame(index=df.index)
+
+    for f in fields:
+        x = df[f].astype(float)
+        median = x.groupby(keys, observed=True).transform('median')
+        mad = (x - median).abs().groupby(keys, observed=True).transform('median')
+
+        scores[f + '_median'] = median
+        scores[f + '_mad'] = mad
+        scores[f + '_robust_z'] = ((x - median) / (_MAD_SCALE * mad)).where(mad > 0)
+        scores[f + '_pct_rank'] = x.groupby(keys, observed=True).rank(pct=True)
+
+    return scores
+
+
+# Default quantiles of the column profiles
+_PROFILE_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+_PROFILE_MOMENTS = ['count', 'nulls', 'min', 'max', 'mean', 'm2']
+
+
+def _bottom_k(df, keys, by, k):
+    '''
+    Keeps, within each group of keys, the k rows with the smallest by.
+    '''
+
+    df = df.sort_values(keys + [by], kind='mergesort')
+    return df[df.groupby(keys, sort=False).cumcount().values < k]
+
+
+class ColumnProfiles:
+    '''
+    Mergeable profiles of the columns of a panel, by date.
+
+    For each (date, column), the profile keeps:
+
+    - moments: the count of values, the count of nulls, the min, the max, the mean and
+      the sum of squared deviations from the mean (numeric columns only for the last four)
+    - hashes: the k smallest distinct 64-bit hashes of the values, from which the number
+      of distinct values is estimated as (k - 1) / (k-th smallest hash / 2 ** 64), with a
+      relative standard error of about 1 / sqrt(k - 2), and counted exactly when there are
+      fewer than k distinct values
+    - sample: the k values with the smallest random priorities, a uniform sample of the
+      values from which the quantiles are estimated (numeric columns only)
+
+    Each accumulator is built in a single scan of the column, and two profiles merge
+    into the profile of the union of their rows: counts add up, means and squared
+    deviations combine exactly, and the hashes and the sample keep the k smallest of
+    both sides. Profiles of date chunks, or of row chunks of the same dates, can be
+    built separately, e.g. in parallel, and merged.
+    '''
+
+    def __init__(self, moments, hashes, sample, k=256):
+
+        self.moments = moments
+        self.hashes = hashes
+        self.sample = sample
+        self.k = k
+
+
+    @classmethod
+    def from_frame(cls, df, columns=None, k=256, seed=0):
+        '''
+        Profiles the columns of a panel.
+
+        :param df: panel with a date column
+        :param columns: columns to profile, all but date if None
+        :param k: size of the distinct hashes and of the sample of each (date, column)
+        :param seed: seed of the random priorities of the sample
+        :return: ColumnProfiles
+        '''
+
+        if columns is None:
+            columns = [c for c in df.columns if c != 'date']
+
+        df = df[df['date'].notnull()]
+
+        # Rows sorted by date once, the codes of the dates being the groups
+        codes, dates = pd.factorize(df['date'], sort=True)
+        order = np.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        starts = np.searchsorted(codes, np.arange(len(dates)))
+        n_rows = np.diff(np.append(starts, len(codes)))
+
+        random_state = np.random.RandomState(seed)
+        moments, hashes, sample = [], [], []
+
+        for c in columns:
+            series = df[c]
+            numeric = pd.api.types.is_numeric_dtype(series) and len(dates) > 0
+
+            if numeric:
+                values = series.to_numpy(dtype=float, na_value=np.nan)[order]
+            else:
+                values = np.asarray(series, dtype=object)[order]
+
+            notnull = pd.notnull(values)
+            count = np.bincount(codes, weights=notnull, minlength=len(dates))
+
+            m = pd.DataFrame({'date': dates, 'column': c, 'count': count, 'nulls': n_rows - count},
+                             columns=['date', 'column'] + _PROFILE_MOMENTS)
+
+            if numeric:
+                x = np.where(notnull, values, 0.0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = np.bincount(codes, weights=x, minlength=len(dates)) / count
+                deviations = np.where(notnull, values - mean[codes], 0.0)
+
+                m['min'] = np.fmin.reduceat(values, starts)
+                m['max'] = np.fmax.reduceat(values, starts)
+                m['mean'] = mean
+                m['m2'] = np.bincount(codes, weights=deviations ** 2, minlength=len(dates))
+
+                s = pd.DataFrame({'date': dates[codes[notnull]], 'column': c,
+                                  'priority': random_state.random_sample(notnull.sum()), 'value': values[notnull]},
+                                 columns=['date', 'column', 'priority', 'value'])
+                sample.append(_bottom_k(s, ['date', 'column'], 'priority', k))
+
+            moments.append(m)
+
+            h = pd.DataFrame({'date': dates[codes[notnull]], 'column': c, 'hash': pd.util.hash_array(values[notnull])},
+                             columns=['date', 'column', 'hash'])
+            hashes.append(_bottom_k(h.drop_duplicates(), ['date', 'column'], 'hash', k))
+
+        return cls(cls._concat(moments, _PROFILE_MOMENTS),
+                   cls._concat(hashes, ['hash']),
+                   cls._concat(sample, ['priority', 'value']),
+                   k)
+
+
+    @staticmethod
+    def _concat(frames, columns):
+        if not frames:
+            return pd.DataFrame(columns=['date', 'column'] + columns)
+        return pd.concat(frames, ignore_index=True)
+
+
+    @staticmethod
+    def _combine_moments(m, keys):
+        '''
+        Combines the moments of the rows of m with the same keys.
+        '''
+
+        grouped = m.groupby(keys, sort=True)
+        total = grouped['count'].transform('sum')
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (m['mean'] * m['count']).groupby([m[c] for c in keys]).transform('sum') / total
+
+        m = m.assign(weighted=m['mean'] * m['count'],
+                     spread=m['m2'] + m['count'] * (m['mean'] - mean) ** 2)
+        grouped = m.groupby(keys, sort=True)
+
+        combined = grouped[['count', 'nulls']].sum()
+        combined['min'] = grouped['min'].min()
+        combined['max'] = grouped['max'].max()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            combined['mean'] = grouped['weighted'].sum(min_count=1) / combined['count']
+        combined['m2'] = grouped['spread'].sum(min_count=1)
+
+        return combined.reset_index()
+
+
+    def merge(self, other):
+        '''
+        :param other: ColumnProfiles
+        :return: the ColumnProfiles of the union of the rows of both profiles
+        '''
+
+        k = min(self.k, other.k)
+        keys = ['date', 'column']
+
+        moments = self._combine_moments(pd.concat([self.moments, other.moments], ignore_index=True), keys)
+        hashes = pd.concat([self.hashes, other.hashes], ignore_index=True).drop_duplicates()
+        sample = pd.concat([self.sample, other.sample], ignore_index=True)
+
+        return ColumnProfiles(moments[keys + _PROFILE_MOMENTS],
+                              _bottom_k(hashes, keys, 'hash', k),
+                              _bottom_k(sample, keys, 'priority', k),
+                              k)
+
+
+    def summary(self, by_date=True, quantiles=None):
+        '''
+        :param by_date: whether to profile each date, or all the dates together
+        :param quantiles: quantiles to estimate, _PROFILE_QUANTILES if None
+        :return: dataframe indexed by (date, column), or by column, with count, nulls, distinct,
+            min, max, mean, std and the quantiles
+        '''
+
+        if quantiles is None:
+            quantiles = _PROFILE_QUANTILES
+
+        moments, hashes, sample = self.moments, self.hashes, self.sample
+        if by_date:
+            keys = ['date', 'column']
+        else:
+            keys = ['column']
+            moments = self._combine_moments(moments, keys)
+            hashes = _bottom_k(hashes[['column', 'hash']].drop_duplicates(), keys, 'hash', self.k)
+            sample = _bottom_k(sample, keys, 'priority', self.k)
+
+        profiles = moments.set_index(keys).sort_index()[['count', 'nulls', 'min', 'max', 'mean', 'm2']].astype(float)
+
+        n_hashes = hashes.groupby(keys).size()
+        kth = hashes.groupby(keys)['hash'].max().astype(float) / 2.0 ** 64
+        distinct = pd.Series(np.where(n_hashes >= self.k, (self.k - 1) / kth, n_hashes), index=n_hashes.index)
+        profiles['distinct'] = distinct.reindex(profiles.index).fillna(0.0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profiles['std'] = np.sqrt(profiles['m2'] / (profiles['count'] - 1)).where(profiles['count'] > 1)
+
+        grouped = sample.groupby(keys)['value']
+        names = ['q%g' % (100 * q) for q in quantiles]
+        for q, name in zip(quantiles, names):
+            profiles[name] = grouped.quantile(q).reindex(profiles.index) if len(sample) else np.nan
+
+        return profiles[['count', 'nulls', 'distinct', 'min', 'max', 'mean', 'std'] + names]
+
+
+class QuantileSketch:
+    '''
+    Mergeable streaming quantile sketch (KLL, Karnin, Lang and Liberty, 2016).
+
+    The values are kept in levels of buffers, the values of level h standing for 2 ** h
+    values each. When a level exceeds its capacity, it is sorted and every other value,
+    starting at a random offset, is promoted to the next level. The capacity of the top
+    level is k, and the capacities decrease by a factor 2/3 towards the lower levels, so
+    the memory is about 3 * k values whatever the number of values.
+
+    The error is on the rank: with k=200, the rank of the value returned for a quantile q
+    is within about 1.65% of q * n with 99% confidence, and the error decreases
+    roughly as 1 / k. Merging two sketches gives the same guarantee for the union.
+    Missing values are ignored.
+    '''
+
+    def __init__(self, k=200, seed=None):
+        '''
+        :param k: capacity of the top level, which sets the accuracy
+        :param seed: seed of the random offsets of the compactions
+        '''
+
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.random_state = np.random.RandomState(seed)
+
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                items = np.sort(items)
+                # An odd item stays at its level
+                kept, items = items[:len(items) % 2], items[len(items) % 2:]
+                promoted = items[self.random_state.randint(2)::2]
+
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+                # The capacities of the lower levels shrink when a level is added
+                level = 0
+            else:
+                level += 1
+
+
+    def update(self, values):
+        '''
+        Adds a chunk of values.
+
+        :param values: array-like of numbers
+        :return: self
+        '''
+
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+        return self
+
+
+    def merge(self, other):
+        '''
+        Adds the values of another sketch.
+
+        :param other: QuantileSketch
+        :return: self
+        '''
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+
+        self.n += other.n
+        self._compress()
+
+        return self
+
+
+    def _weighted(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+
+        return values[order], np.cumsum(weights[order])
+
+
+    def quantile(self, q):
+        '''
+        :param q: quantile or array of quantiles, between 0 and 1
+        :return: estimated quantile(s), NaN if the sketch is empty
+        '''
+
+        values, cumulative = self._weighted()
+        if not len(values):
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+
+        positions = np.searchsorted(cumulative, np.asarray(q, dtype=float) * cumulative[-1], side='left')
+
+        return values[np.minimum(positions, len(values) - 1)]
+
+
+    def rank(self, x):
+        '''
+        :param x: value or array of values
+        :return: estimated fraction of the values that are <= x
+        '''
+
+        values, cumulative = self._weighted()
+        if not len(values):
+            return np.full(np.shape(x), np.nan) if np.ndim(x) else np.nan
+
+        positions = np.searchsorted(values, x, side='right')
+
+        return np.where(positions > 0, cumulative[np.maximum(positions - 1, 0)], 0.0) / cumulative[-1]
+
+
+    def __len__(self):
+        return self.n
+
+
+
+
+def _leading_zeros(w):
+    '''
+    :param w: uint64 array
+    :return: number of leading zero bits of each value, 64 for 0
+    '''
+
+    w = w.copy()
+    zeros = np.zeros(len(w), dtype=np.int64)
+
+    for shift in [32, 16, 8, 4, 2, 1]:
+        small = w < np.uint64(1 << (64 - shift))
+        zeros += small * shift
+        w = np.where(small, w << np.uint64(shift), w)
+
+    return zeros + (w == 0)
+
+
+class DistinctCounter:
+    '''
+    Mergeable streaming estimate of the number of distinct values (HyperLogLog,
+    Flajolet, Fusy, Gandouet and Meunier, 2007).
+
+    The 64-bit hash of each value selects one of 2 ** p registers with its first p bits,
+    and the register keeps the highest position of the first 1 bit in the remaining
+    bits. The memory is 2 ** p bytes whatever the number of values: 4KB with the default
+    p=12. The relative standard error of the estimate is 1.04 / sqrt(2 ** p), 1.6% with
+    p=12, and small counts are corrected with linear counting. Merging two counters with
+    the same p gives the counter of the union of their values. Values are hashed as given,
+    e.g. 1 and 1.0 are distinct, and missing values are ignored.
+    '''
+
+    def __init__(self, p=12):
+        '''
+        :param p: number of bits of the register index, between 7 and 18
+        '''
+
+        if p < 7 or p > 18:
+            raise ValueError('p must be between 7 and 18')
+
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+
+    def update(self, values):
+        '''
+        Adds a chunk of values.
+
+        :param values: array-like
+        :return: self
+        '''
+
+        values = np.asarray(values)
+        values = values[pd.notnull(values)]
+        if not len(values):
+            return self
+
+        hashes = pd.util.hash_array(values)
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rank = np.minimum(_leading_zeros(hashes << np.uint64(self.p)) + 1, 64 - self.p + 1)
+
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+        return self
+
+
+    def merge(self, other):
+        '''
+        :param other: DistinctCounter with the same p
+        :return: self
+        '''
+
+        if other.p != self.p:
+            raise ValueError('Cannot merge counters with p=%d and p=%d' % (self.p, other.p))
+
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+        return self
+
+
+    def estimate(self):
+        '''
+        :return: estimated number of distinct values
+        '''
+
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1.0 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(float))
+
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and empty > 0:
+            estimate = m * np.log(m / empty)
+
+        return estimate
+
+
+
+# Types of the declarative value rules, see RuleCompiler
+_RULE_TYPES = ['range', 'not_null', 'allowed', 'expression']
+
+
+class RuleCompiler:
+    '''
+    Compiles declarative value rules into vectorized violation masks.
+
+    A rule is a dictionary with a name, a type and the parameters of its type:
+
+    - range: column, and min and/or max, inclusive by default ('inclusive': False for strict bounds)
+    - not_null: column
+    - allowed: column and values, the list of allowed values
+    - expression: expression, evaluated with DataFrame.eval, e.g. 'size_mm <= 2 * cap_mm'
+
+    Missing values only violate not_null rules, and expressions that evaluate to
+    anything but True. Each rule is compiled into a combination of atomic masks
+    (null test, comparison with a bound, membership, expression) and an atomic
+    mask shared by several rules is only computed once per evaluation.
+    '''
+
+    def __init__(self, rules):
 
+        self.rules = []
+        self.atoms = {}
 
+        for i, rule in enumerate(rules):
+            rule = dict(rule)
+            rule.setdefault('name', 'rule_%d' % i)
+            if rule.get('type') not in _RULE_TYPES:
+                raise ValueError('Rule %s has type %s, it must be one of %s' % (rule['name'], rule.get('type'), _RULE_TYPES))
+            self.rules.append((rule['name'], self._compile(rule)))
+
+
+    def _atom(self, *key):
+        self.atoms[key] = None
+        return key
+
+
+    def _compile(self, rule):
+        '''
+        :return: list of (atom, negate) whose masks are or-ed to give the violations
+        '''
+
+        kind = rule['type']
+
+        if kind == 'not_null':
+            return [(self._atom('isnull', rule['column']), False)]
+
+        if kind == 'range':
+            inclusive = rule.get('inclusive', True)
+            terms = []
+            if rule.get('min') is not None:
+                terms.append((self._atom('lt' if inclusive else 'le', rule['column'], rule['min']), False))
+            if rule.get('max') is not None:
+                terms.append((self._atom('gt' if inclusive else 'ge', rule['column'], rule['max']), False))
+            return terms
+
+        if kind == 'allowed':
+            return [(self._atom('notallowed', rule['column'], tuple(sorted(set(rule['values']), key=repr))), False)]
+
+        return [(self._atom('expression', rule['expression']), True)]
+
+
+    @staticmethod
+    def _evaluate_atom(df, key):
+        op = key[0]
+        if op == 'isnull':
+            return df[key[1]].isnull().values
+        if op == 'expression':
+            return (df.eval(key[1]) == True).values
+        if op == 'notallowed':
+            return (df[key[1]].notnull() & ~df[key[1]].isin(key[2])).values
+
+        values = df[key[1]]
+        if op == 'lt':
+            return (values < key[2]).values
+        if op == 'le':
+            return (values <= key[2]).values
+        if op == 'gt':
+            return (values > key[2]).values
+        return (values >= key[2]).values
+
+
+    def evaluate(self, df):
+        '''
+        Evaluates all the rules over df.
+
+        :param df: dataframe
+        :return: dictionary of the violation mask of each rule, as numpy boolean arrays
+        '''
+
+        masks = dict((key, self._evaluate_atom(df, key)) for key in self.atoms)
+
+        violations = {}
+        for name, terms in self.rules:
+            mask = np.zeros(len(df), dtype=bool)
+            for key, negate in terms:
+                mask |= ~masks[key] if negate else masks[key]
+            violations[name] = mask
+
+        return violations
+
+
+class QCCheck:
+
+    __type__ = 'GENERIC'
+    __type_description__ = 'This is a base generic test'
+
+    def __init__(self,
+                 id=None,
+                 description=None,
+                 **kwargs):
+        '''
+        This is the base class for all QC Checks classes
+
+        Checks to make sure all arguments are initialized.
+
+        :param name:
+        :param kwargs:
+        '''
+
+        if id is None:
+            raise ValueError('id must be specified')
+        else:
+            self.id = id
+
+        if description is None:
+            raise ValueError('description must be specified')
+        else:
+            self.description = description
+
+
+    # Overloads the print statement
+    def __str__(self):
+        s =  'Id               = ' + self.id + '\n'
+        s += 'Description      = ' + self.description + '\n'
+        s += 'Type             = ' + self.__type__ + '\n'
+        s += 'Type description = ' + self.__type_description__ + '\n'
+
+        return s
+
+
+    def metadata(self):
+        '''
+        :return: dictionary of the items of __QCCHECK_METADATA_ITEMS__
+        '''
+
+        values = {'description': self.description,
+                  'id': self.id,
+                  'type': self.__type__,
+                  'type_description': self.__type_description__}
+
+        return dict((item, values[item]) for item in __QCCHECK_METADATA_ITEMS__)
+
+
+    def parameters(self):
+        '''
+        :return: dictionary of the constructor parameters of the check, besides id and description
+        '''
+
+        return {}
+
+
+    def definition(self):
+        '''
+        :return: the metadata and the parameters of the check
+        '''
+
+        definition = self.metadata()
+        definition['parameters'] = self.parameters()
+
+        return definition
+
+
+    # Saves the check definition in the persistence layer
+    def upload_check_definition(self, store):
+        '''
+        :param store: QCStore
+        '''
+
+        store.save_definition(self)
+
+
+    # Retrieves the check definition from the persistence layer, and reinitializes the check with it
+    def download_check_definition(self, store):
+        '''
+        :param store: QCStore
+        :return: self
+        '''
+
+        definition = store.definition(self.id)
+        if definition is None:
+            raise ValueError('No definition of check %s in %s' % (self.id, store.path))
+        if definition['type'] != self.__type__:
+            raise ValueError('Check %s is stored with type %s, not %s' % (self.id, definition['type'], self.__type__))
+
+        self.__init__(id=self.id, description=definition['description'], **definition['parameters'])
+
+        return self
+
+
+
+
+
+class TimeSeriesQCCheck(QCCheck):
+    '''
+    This is the base class for all Time Series QC Checks classes
 
-class QCCheck:
+    For each id and each field, the check looks at the level, the absolute change and
+    the relative change from the previous date of the id. Each value is compared with
+    the rolling and the exponentially weighted mean and standard deviation of the
+    previous values of the same id, and flagged when its z-score exceeds the threshold.
+    '''
 
-    __type__ = 'GENERIC'
-    __type_description__ = 'This is a base generic test'
+    __type__ = 'TIME_SERIES'
+    __type_description__ = 'This check uses a times series to identify anomalous values'
 
     def __init__(self,
                  id=None,
                  description=None,
+                 fields=None,
+                 window=20,
+                 halflife=10,
+                 min_periods=5,
+                 threshold=4.0,
+                 thresholds=None,
                  **kwargs):
         '''
-        This is the base class for all QC Checks classes
+        :param fields: columns to check, which must be specified before the check is run
+        :param window: number of previous dates of the rolling statistics
+        :param halflife: halflife, in dates, of the exponentially weighted statistics
+        :param min_periods: minimum number of previous values to compute a z-score
+        :param threshold: absolute z-score above which a value is flagged
+        :param thresholds: optional dictionary of thresholds by z-score column, e.g. {'size_mm_ewm_z': 3}
+        '''
 
-        Checks to make sure all arguments are initialized.
+        QCCheck.__init__(self, id, description, **kwargs)
 
-        :param name:
-        :param kwargs:
+        self.fields = list(fields) if fields is not None else None
+        self.window = window
+        self.halflife = halflife
+        self.alpha = 1.0 - np.exp(np.log(0.5) / halflife)
+        self.min_periods = min_periods
+        self.threshold = threshold
+        self.thresholds = thresholds if thresholds is not None else {}
+
+
+    def parameters(self):
+        return {'fields': self.fields,
+                'window': self.window,
+                'halflife': self.halflife,
+                'min_periods': self.min_periods,
+                'threshold': self.threshold,
+                'thresholds': self.thresholds}
+
+
+    def _series(self, df, codes):
+        '''
+        Builds the matrix of the level, absolute change and relative change of each
+        field, rows sorted by (id, date).
         '''
 
-        if id is None:
-            raise ValueError('id must be specified')
-        else:
-            self.id = id
+        levels = _finite(df[self.fields].values.astype(float))
+        previous = np.full(levels.shape, np.nan)
+        same_id = np.zeros(len(codes), dtype=bool)
+        same_id[1:] = codes[1:] == codes[:-1]
+        previous[1:][same_id[1:]] = levels[:-1][same_id[1:]]
 
-        if description is None:
-            raise ValueError('description must be specified')
-        else:
-            self.description = description
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change_abs = levels - previous
+            change_rel = change_abs / np.abs(previous)
 
+        names = [_ts_series_name(f, kind) for kind in _TS_SERIES for f in self.fields]
 
-    # Overloads the print statement
-    def __str__(self):
-        s =  'Id               = ' + self.id + '\n'
-        s += 'Description      = ' + self.description + '\n'
-        s += 'Type             = ' + self.__type__ + '\n'
-        s += 'Type description = ' + self.__type_description__ + '\n'
+        # Non-finite values would be taken as known values by the statistics of the id
+        return _finite(np.hstack([levels, change_abs, change_rel])), names
 
-        return s
 
+    def _flag(self, stats, z_columns):
+        flags = np.zeros(len(stats), dtype=int)
+        for c in z_columns:
+            flags += (stats[c].abs() > self.thresholds.get(c, self.threshold)).values
 
-    # Saves the check definition in the persistence layer
-    def upload_check_definition(self):
-        pass
+        stats['n_flags'] = flags
 
+        return stats
 
-    # Retrieves the check results in the persistence layer
-    def download_check_definition(self):
-        pass
 
+    def run_check(self, df):
+        '''
+        Computes the statistics of all the ids at once and flags the anomalous values.
 
+        :param df: panel with id, date and the fields
+        :return: QCResult with the counts by date as summary and the rows with at least one flag as flagged rows
+        '''
 
+        if self.fields is None:
+            raise ValueError('fields must be specified')
 
+        timings = {}
 
-class TimeSeriesQCCheck(QCCheck):
-    '''
-    This is the base class for all Time Series QC Checks classes
-    '''
+        start = time.perf_counter()
+        df = df.dropna(subset=['id', 'date']).sort_values(['id', 'date'], kind='mergesort')
+        df = df.drop_duplicates(subset=['id', 'date'], keep='last').reset_index(drop=True)
 
-    __type__ = 'TIME_SERIES'
-    __type_description__ = 'This check uses a times series to identify anomalous values'
+        codes = pd.factorize(df['id'])[0]
+        positions = np.unique(df['date'].values, return_inverse=True)[1].ravel()
+        values, names = self._series(df, codes)
+        timings['prepare'] = time.perf_counter() - start
 
-    def __init__(self,
-                 id=None,
-                 description=None,
-                 **kwargs):
+        start = time.perf_counter()
+        rolling_mean, rolling_std = rolling_prior_stats(values, codes, self.window, self.min_periods)
+        timings['rolling'] = time.perf_counter() - start
 
-        QCCheck.__init__(self, id, description, **kwargs)
+        start = time.perf_counter()
+        ewm_mean, ewm_std, state = ewm_prior_stats(values, codes, positions, self.alpha, self.min_periods)
+        self.__state__ = self._build_state(df, codes, values, state)
+        timings['ewm'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats = self._stats_frame(df, values, names, rolling_mean, rolling_std, ewm_mean, ewm_std)
+        result = self._result(stats, timings, start)
+
+        return result
+
+
+    def _build_state(self, df, codes, values, state):
+        '''
+        Completes the EWM state of each id with the last date, the last level of the
+        fields and a buffer of the last window values of each series, oldest first.
+        Rows must be sorted by (id, date).
+        '''
+
+        n_ids = len(state['mean'])
+        n_fields = len(self.fields)
+
+        ends = np.searchsorted(codes, codes, side='right')
+        rank = ends - np.arange(len(codes)) - 1
+        last = rank == 0
+        recent = rank < self.window
+
+        state['ids'] = np.asarray(pd.unique(df['id']))
+        state['last_date'] = np.full(n_ids, np.datetime64('NaT'), dtype='datetime64[ns]')
+        state['last_date'][codes[last]] = pd.DatetimeIndex(df['date']).values[last]
+        state['last_level'] = np.full((n_ids, n_fields), np.nan)
+        state['last_level'][codes[last]] = values[last, :n_fields]
+        state['buffer'] = np.full((n_ids, self.window, values.shape[1]), np.nan)
+        state['buffer'][codes[recent], self.window - 1 - rank[recent]] = values[recent]
+
+        return state
+
+
+    def _settings(self):
+        return np.array([','.join(self.fields), str(self.window), repr(self.alpha), str(self.min_periods)])
+
+
+    def save_state(self, path):
+        '''
+        Saves the per-id state of the last run in a compressed numpy file.
+
+        :param path: path of the file
+        :return: None
+        '''
+
+        np.savez_compressed(path, settings=self._settings(), **self.__state__)
+
+
+    def load_state(self, path):
+        '''
+        Loads a per-id state saved by save_state. The state must have been saved by a
+        check with the same fields, window, halflife and min_periods.
+
+        :param path: path of the file
+        :return: None
+        '''
+
+        with np.load(path, allow_pickle=True) as data:
+            if list(data['settings']) != list(self._settings()):
+                raise ValueError('The state in %s was saved with different settings' % path)
+            self.__state__ = dict((k, data[k]) for k in data.files if k != 'settings')
+
+
+    def _grow_state(self, ids):
+        '''
+        Adds the ids that are not in the state yet.
+
+        :return: the codes of ids in the state
+        '''
+
+        state = self.__state__
+        known = pd.Index(state['ids'])
+        new = pd.unique(np.asarray(ids)[known.get_indexer(ids) < 0])
+
+        if len(new):
+            n = len(new)
+            state['ids'] = np.concatenate([state['ids'], np.asarray(new, dtype=state['ids'].dtype if len(state['ids']) else None)])
+            for k in ['mean', 'var', 'count']:
+                state[k] = np.vstack([state[k], np.zeros((n,) + state[k].shape[1:])])
+            state['last_date'] = np.concatenate([state['last_date'], np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')])
+            state['last_level'] = np.vstack([state['last_level'], np.full((n,) + state['last_level'].shape[1:], np.nan)])
+            state['buffer'] = np.concatenate([state['buffer'], np.full((n,) + state['buffer'].shape[1:], np.nan)])
+
+        return pd.Index(state['ids']).get_indexer(ids)
+
+
+    def update_check(self, df, state_file):
+        '''
+        Runs the check on newly arrived dates only, starting from the state saved in
+        state_file, and saves the updated state. The cost only depends on the number
+        of new rows. Rows that are not after the last date of their id in the state
+        are ignored. If state_file does not exist yet, df is treated as the full
+        history: run_check is used and the state is saved.
+
+        :param df: new rows with id, date and the fields
+        :param state_file: path of the state file
+        :return: QCResult for the new rows
+        '''
+
+        if self.fields is None:
+            raise ValueError('fields must be specified')
+
+        if not os.path.exists(state_file):
+            result = self.run_check(df)
+            self.save_state(state_file)
+            return result
+
+        self.load_state(state_file)
+
+        timings = {}
+        start = time.perf_counter()
+
+        df = df.dropna(subset=['id', 'date']).sort_values(['id', 'date'], kind='mergesort')
+        df = df.drop_duplicates(subset=['id', 'date'], keep='last').reset_index(drop=True)
+
+        codes = self._grow_state(df['id'].values)
+        state = self.__state__
+        dates = pd.DatetimeIndex(df['date']).values.astype('datetime64[ns]')
+
+        fresh = np.isnat(state['last_date'][codes]) | (dates > state['last_date'][codes])
+        if not fresh.all():
+            logger.warning('Ignoring %d rows that are not after the last date of their id', (~fresh).sum())
+            df, codes, dates = df[fresh].reset_index(drop=True), codes[fresh], dates[fresh]
+
+        levels = _finite(df[self.fields].values.astype(float))
+        k = state['buffer'].shape[2]
+        values = np.full((len(df), k), np.nan)
+        rolling_mean = np.full((len(df), k), np.nan)
+        rolling_std = np.full((len(df), k), np.nan)
+        ewm_mean = np.full((len(df), k), np.nan)
+        ewm_std = np.full((len(df), k), np.nan)
+        n_fields = len(self.fields)
+        timings['prepare'] = time.perf_counter() - start
+
+        # Usually a single date: each date is processed with the ids observed on that date
+        start = time.perf_counter()
+        for date in np.unique(dates):
+            rows = np.where(dates == date)[0]
+            c = codes[rows]
+
+            x = levels[rows]
+            previous = state['last_level'][c]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                change_abs = x - previous
+                values[rows] = _finite(np.hstack([x, change_abs, change_abs / np.abs(previous)]))
+
+            buffer = state['buffer'][c]
+            n = (~np.isnan(buffer)).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.nansum(buffer, axis=1) / n
+                std = np.sqrt(np.nansum((buffer - mean[:, None, :]) ** 2, axis=1) / n)
+            rolling_mean[rows] = np.where(n >= self.min_periods, mean, np.nan)
+            rolling_std[rows] = np.where(n >= self.min_periods, std, np.nan)
+
+            ewm_mean[rows], ewm_std[rows], _ = ewm_prior_stats(values[rows], c, np.zeros(len(rows), dtype=int),
+                                                               self.alpha, self.min_periods, state)
+
+            state['buffer'][c] = np.concatenate([buffer[:, 1:], values[rows][:, None, :]], axis=1)
+            state['last_level'][c] = x[:, :n_fields]
+            state['last_date'][c] = date
+        timings['update'] = time.perf_counter() - start
+
+        self.save_state(state_file)
+
+        start = time.perf_counter()
+        names = [_ts_series_name(f, kind) for kind in _TS_SERIES for f in self.fields]
+        stats = self._stats_frame(df, values, names, rolling_mean, rolling_std, ewm_mean, ewm_std)
+
+        return self._result(stats, timings, start)
+
+
+    def _stats_frame(self, df, values, names, rolling_mean, rolling_std, ewm_mean, ewm_std):
+        columns = {'id': df['id'].values, 'date': df['date'].values}
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for j, name in enumerate(names):
+                columns[name] = values[:, j]
+                columns[name + '_rolling_mean'] = rolling_mean[:, j]
+                columns[name + '_rolling_std'] = rolling_std[:, j]
+                columns[name + '_rolling_z'] = np.where(rolling_std[:, j] > 0, (values[:, j] - rolling_mean[:, j]) / rolling_std[:, j], np.nan)
+                columns[name + '_ewm_mean'] = ewm_mean[:, j]
+                columns[name + '_ewm_std'] = ewm_std[:, j]
+                columns[name + '_ewm_z'] = np.where(ewm_std[:, j] > 0, (values[:, j] - ewm_mean[:, j]) / ewm_std[:, j], np.nan)
+
+        return pd.DataFrame(columns, columns=list(columns.keys()))
+
+
+    def _result(self, stats, timings, start):
+        z_columns = [c for c in stats.columns if c.endswith('_z')]
+        stats = self._flag(stats, z_columns)
+        self.__stats__ = stats
+
+        flagged = stats[stats['n_flags'] > 0].sort_values(['date', 'id'])
+
+        by_date = stats.assign(flagged=stats['n_flags'] > 0).groupby('date')
+        summary = pd.DataFrame({'n_obs': by_date['id'].count(),
+                                'n_flagged': by_date['flagged'].sum()},
+                               columns=['n_obs', 'n_flagged'])
+        timings['flag'] = time.perf_counter() - start
+
+        return QCResult(metadata=self.metadata(), summary=summary, flagged=flagged, timings=timings)
 
 
 
 
 class CrossSectionalQCCkeck(QCCheck):
+    '''
+    Compares each value with the other values of the same date, and optionally of the
+    same sector, using the median and the median absolute deviation (MAD) which are not
+    distorted by the outliers themselves. Values whose robust z-score exceeds the
+    threshold are flagged.
+    '''
 
     __type__ = 'CROSS_SECTIONAL'
     __type_description__ = 'This check uses a cross-sectional analysis to identify anomalous values'
@@ -141,15 +1424,95 @@ class CrossSectionalQCCkeck(QCCheck):
     def __init__(self,
                  id=None,
                  description=None,
+                 fields=None,
+                 by_sector=False,
+                 threshold=3.5,
+                 n_jobs=1,
                  **kwargs):
+        '''
+        :param fields: columns to check
+        :param by_sector: whether the cross-sections are by date and sector rather than by date
+        :param threshold: absolute robust z-score above which a value is flagged
+        :param n_jobs: number of processes, the dates being split in n_jobs partitions
+        '''
 
         QCCheck.__init__(self, id, description, **kwargs)
 
+        if fields is None:
+            raise ValueError('fields must be specified')
+
+        self.fields = list(fields)
+        self.by = ['date', 'sector'] if by_sector else ['date']
+        self.threshold = threshold
+        self.n_jobs = n_jobs
+
+
+    def parameters(self):
+        return {'fields': self.fields,
+                'by_sector': 'sector' in self.by,
+                'threshold': self.threshold,
+                'n_jobs': self.n_jobs}
+
+
+    def _scores(self, df):
+        if self.n_jobs <= 1:
+            return robust_cross_section(df, self.fields, self.by)
+
+        # Contiguous date partitions: no cross-section is split between two processes
+        df = df.sort_values('date', kind='mergesort')
+        positions = np.unique(df['date'].values, return_inverse=True)[1].ravel()
+        bounds = np.searchsorted(positions, [p[0] for p in np.array_split(np.arange(positions.max() + 1), self.n_jobs) if len(p)])
+        bounds = np.append(bounds, len(df))
+
+        columns = self.by + self.fields
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = [executor.submit(robust_cross_section, df[columns].iloc[bounds[i]:bounds[i + 1]], self.fields, self.by)
+                       for i in range(len(bounds) - 1)]
+            return pd.concat([f.result() for f in futures])
+
+
+    def run_check(self, df):
+        '''
+        Scores all the cross-sections and flags the outliers.
+
+        :param df: panel with date, the fields, and sector when checking by sector
+        :return: QCResult with the counts by date as summary and the rows with at least one outlier as flagged rows
+        '''
+
+        timings = {}
+
+        start = time.perf_counter()
+        df = df.dropna(subset=self.by)
+        scores = self._scores(df).reindex(df.index)
+        timings['scores'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats = pd.concat([df, scores], axis=1)
+
+        flags = np.zeros(len(stats), dtype=int)
+        for f in self.fields:
+            flags += (stats[f + '_robust_z'].abs() > self.threshold).values
+        stats['n_flags'] = flags
+        self.__stats__ = stats
+
+        flagged = stats[stats['n_flags'] > 0].sort_values(self.by)
+
+        by_date = stats.assign(flagged=stats['n_flags'] > 0).groupby('date')
+        summary = pd.DataFrame({'n_obs': by_date['n_flags'].count(),
+                                'n_flagged': by_date['flagged'].sum()},
+                               columns=['n_obs', 'n_flagged'])
+        timings['flag'] = time.perf_counter() - start
+
+        return QCResult(metadata=self.metadata(), summary=summary, flagged=flagged, timings=timings)
+
 
 
 
 
 class ValueQCCkeck(QCCheck):
+    '''
+    Evaluates a list of declarative value rules, see RuleCompiler, over a dataframe.
+    '''
 
     __type__ = 'VALUE_BASED'
     __type_description__ = 'This check uses a rule and value to identify anomalous values'
@@ -157,19 +1520,155 @@ class ValueQCCkeck(QCCheck):
     def __init__(self,
                  id=None,
                  description=None,
+                 rules=None,
                  **kwargs):
+        '''
+        :param rules: list of rule dictionaries
+        '''
 
         QCCheck.__init__(self, id, description, **kwargs)
 
+        self.rules = list(rules) if rules is not None else []
+        self.compiler = RuleCompiler(self.rules)
+
+
+    def parameters(self):
+        return {'rules': self.rules}
+
+
+    def run_check(self, df):
+        '''
+        Evaluates all the rules over df.
+
+        :param df: dataframe
+        :return: QCResult with the number of violations of each rule as summary, the rows that
+            violate at least one rule as flagged rows, and the index of the violating rows of each
+            rule in details['violations']
+        '''
+
+        timings = {}
+
+        start = time.perf_counter()
+        violations = self.compiler.evaluate(df)
+        timings['evaluate'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        n_violations = np.zeros(len(df), dtype=int)
+        for mask in violations.values():
+            n_violations += mask
+
+        summary = pd.DataFrame({'n_violations': [int(m.sum()) for m in violations.values()]},
+                               index=pd.Index(list(violations.keys()), name='rule'))
+
+        flagged = df[n_violations > 0].assign(n_violations=n_violations[n_violations > 0])
+        details = {'violations': dict((name, df.index[mask]) for name, mask in violations.items())}
+        timings['summary'] = time.perf_counter() - start
+
+        return QCResult(metadata=self.metadata(), summary=summary, flagged=flagged, timings=timings, details=details)
+
 
 
 
 
 class XRayQCCheck(QCCheck):
+    '''
+    Profiles each column of a panel on each date, see ColumnProfiles, and flags the
+    (date, column) profiles whose fraction of nulls exceeds max_null_fraction.
+
+    With n_jobs > 1, the dates are split into n_jobs contiguous partitions which are
+    profiled in parallel and merged.
+    '''
 
     __type__ = 'XRAY'
     __type_description__ = 'This check runs a comprehensive set of checks'
 
+    def __init__(self,
+                 id=None,
+                 description=None,
+                 columns=None,
+                 quantiles=None,
+                 k=256,
+                 max_null_fraction=None,
+                 n_jobs=1,
+                 **kwargs):
+        '''
+        :param columns: columns to profile, all but date if None
+        :param quantiles: quantiles to estimate, _PROFILE_QUANTILES if None
+        :param k: size of the distinct hashes and of the quantile sample of each (date, column)
+        :param max_null_fraction: fraction of nulls above which a (date, column) is flagged, no flags if None
+        :param n_jobs: number of processes
+        '''
+
+        QCCheck.__init__(self, id, description, **kwargs)
+
+        self.columns = list(columns) if columns is not None else None
+        self.quantiles = list(quantiles) if quantiles is not None else list(_PROFILE_QUANTILES)
+        self.k = k
+        self.max_null_fraction = max_null_fraction
+        self.n_jobs = n_jobs
+
+
+    def parameters(self):
+        return {'columns': self.columns,
+                'quantiles': self.quantiles,
+                'k': self.k,
+                'max_null_fraction': self.max_null_fraction,
+                'n_jobs': self.n_jobs}
+
+
+    def profile(self, df):
+        '''
+        :param df: panel with a date column
+        :return: ColumnProfiles of the panel
+        '''
+
+        if self.n_jobs <= 1:
+            return ColumnProfiles.from_frame(df, self.columns, self.k)
+
+        dates = np.sort(df['date'].dropna().unique())
+        partitions = [p for p in np.array_split(dates, self.n_jobs) if len(p)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = [executor.submit(ColumnProfiles.from_frame, df[df['date'].isin(p)], self.columns, self.k, i)
+                       for i, p in enumerate(partitions)]
+            profiles = [f.result() for f in futures]
+
+        merged = profiles[0]
+        for p in profiles[1:]:
+            merged = merged.merge(p)
+
+        return merged
+
+
+    def run_check(self, df):
+        '''
+        Profiles the panel in a single scan of each column.
+
+        :param df: panel with a date column
+        :return: QCResult with the profile of each (date, column) as summary, the profiles with too
+            many nulls as flagged rows, and the ColumnProfiles in details['profiles'] to be merged
+            with the profiles of other dates
+        '''
+
+        timings = {}
+
+        start = time.perf_counter()
+        profiles = self.profile(df)
+        timings['profile'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        summary = profiles.summary(by_date=True, quantiles=self.quantiles)
+
+        if self.max_null_fraction is None:
+            flagged = summary.iloc[:0].reset_index()
+        else:
+            null_fraction = summary['nulls'] / (summary['count'] + summary['nulls'])
+            flagged = summary[null_fraction > self.max_null_fraction].reset_index()
+        timings['summary'] = time.perf_counter() - start
+
+        return QCResult(metadata=self.metadata(), summary=summary, flagged=flagged, timings=timings,
+                        details={'profiles': profiles})
+
 
 
 
@@ -187,83 +1686,361 @@ class HistoricalPanelQCCheck(QCCheck):
 
 
     def _build_date_universe(self):
-        self.__dates__ = pd.DataFrame(self.__df__.date.unique(), columns=['date'])
+        self.__dates__ = pd.DataFrame(np.sort(self.__df__.date.unique()), columns=['date'])
+
+
+    def _build_asset_universe(self, chunk_size=1000000):
+        '''
+        Estimates the number of assets, streaming the ids through a DistinctCounter
+        instead of materializing their unique values.
+        '''
 
+        ids = self.__df__['id'].values
+        self.__assets__ = DistinctCounter()
+        for start in range(0, len(ids), chunk_size):
+            self.__assets__.update(ids[start:start + chunk_size])
 
-    def _build_asset_universe(self):
-        self.__assets__ = pd.DataFrame(self.__df__.id.unique(), columns=['id'])
 
+    def _build_coverage(self):
+        '''
+        Flags the rows of the panel where the id enters the panel and the rows where
+        it drops out of the panel at the next date.
+
+        Only the rows of the panel are used: they are sorted by (id, date) and each row
+        is compared with the neighbouring row of the same id, which is a continuation
+        only if it is at the neighbouring date of the date universe. As before, a row
+        with a missing sector does not count as a presence.
+        '''
+
+        df = self.__df__
+        dates = self.__dates__['date'].values
+
+        positions = np.searchsorted(dates, df['date'].values)
+        id_codes = pd.factorize(df['id'])[0]
+        present = df['sector'].notnull().values
+
+        order = np.lexsort((positions, id_codes))
+        positions = positions[order]
+        id_codes = id_codes[order]
+        present = present[order]
+
+        # Whether the previous and the next rows are the same id, present at the adjacent date
+        adjacent = (id_codes[1:] == id_codes[:-1]) & (positions[1:] == positions[:-1] + 1)
+        previous_present = np.zeros(len(df), dtype=bool)
+        previous_present[1:] = adjacent & present[:-1]
+        next_present = np.zeros(len(df), dtype=bool)
+        next_present[:-1] = adjacent & present[1:]
+
+        enter = present & (positions > 0) & ~previous_present
+        drop = present & (positions < len(dates) - 1) & ~next_present
 
-    def _build_dates_by_assets(self):
-        self.__dates__['dummy'] = 1
-        self.__assets__['dummy'] = 1
+        df_coverage = df.iloc[order].copy()
+        df_coverage['drop_next_period'] = np.where(drop, True, np.nan)
+        df_coverage['enter_this_period'] = np.where(enter, True, np.nan)
 
-        self.__dates_by_assets__ = self.__dates__.merge(self.__assets__, on='dummy').drop(columns=['dummy'])
+        self.__coverage__ = df_coverage
 
 
     def run_check(self, df):
+        '''
+        Finds, for each date of the panel, the ids that enter the panel and the ids that
+        drop out of it at the next date.
+
+        :param df: panel with date, id and sector
+        :return: QCResult with the counts by date as summary and the entering and dropping rows as flagged rows
+        '''
+
+        timings = {}
 
+        start = time.perf_counter()
         self.__df__ = df
         self._build_date_universe()
-        self._build_asset_universe()
-        self._build_dates_by_assets()
+        # The number of assets is only used for logging
+        if logger.isEnabledFor(logging.DEBUG):
+            self._build_asset_universe()
+        timings['universe'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self._build_coverage()
+        df_coverage = self.__coverage__
+        timings['coverage'] = time.perf_counter() - start
+
+        # Creates the summary count of how many securities enter and exit each period
+        start = time.perf_counter()
+        by_date = df_coverage.groupby('date')
+        summary = pd.DataFrame({'n_assets': by_date['sector'].count(),
+                                'enter_this_period': by_date['enter_this_period'].count(),
+                                'drop_next_period': by_date['drop_next_period'].count()},
+                               columns=['n_assets', 'enter_this_period', 'drop_next_period'])
+
+        flagged = df_coverage[df_coverage['enter_this_period'].notnull() | df_coverage['drop_next_period'].notnull()]
+        flagged = flagged.sort_values(['date', 'id'])
+        timings['summary'] = time.perf_counter() - start
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%d dates, about %d assets, %d flagged rows', len(self.__dates__), self.__assets__.estimate(), len(flagged))
+
+        return QCResult(metadata=self.metadata(), summary=summary, flagged=flagged, timings=timings)
+
+
+
+
+# Check classes by type, to rebuild the checks stored in a QCStore
+_CHECK_TYPES = dict((c.__type__, c) for c in [QCCheck, TimeSeriesQCCheck, CrossSectionalQCCkeck, ValueQCCkeck,
+                                              XRayQCCheck, HistoricalPanelQCCheck])
+
+_QCSTORE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS checks (
+           check_id TEXT PRIMARY KEY,
+           type TEXT,
+           type_description TEXT,
+           description TEXT,
+           parameters TEXT,
+           updated_at TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS runs (
+           run_id TEXT PRIMARY KEY,
+           check_id TEXT,
+           dataset TEXT,
+           run_at TEXT,
+           passed INTEGER,
+           n_flagged INTEGER,
+           timings TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS outcomes (
+           run_id TEXT,
+           check_id TEXT,
+           dataset TEXT,
+           date TEXT,
+           passed INTEGER,
+           n_flagged INTEGER,
+           summary TEXT)''',
+    'CREATE INDEX IF NOT EXISTS runs_check_dataset_run_at ON runs (check_id, dataset, run_at)',
+    'CREATE INDEX IF NOT EXISTS outcomes_check_dataset_date ON outcomes (check_id, dataset, date)',
+]
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    return str(value)
+
+
+def _to_json(value):
+    return json.dumps(value, default=_json_default, sort_keys=True)
+
+
+class QCStore:
+    '''
+    Local SQLite store of the QC check definitions and of the QC results.
+
+    - checks: one row per check id, with its type, description and parameters as JSON
+    - runs: one row per run of a check over a dataset, with the overall outcome
+    - outcomes: one row per run and date, with the number of flagged rows of the date
+      and the summary row of the date as JSON. Results without dates are stored with
+      a single outcome whose date is null.
+
+    Results are buffered and written in a single transaction once batch_size outcomes
+    are pending, and when the store is flushed or closed. Dates are stored as ISO
+    strings, and the outcomes are indexed on (check_id, dataset, date), so that the
+    history of a check over a date range is read without scanning the table.
+
+    The store can be used as a context manager, which flushes and closes it on exit.
+    '''
+
+    def __init__(self, path, batch_size=10000):
+        '''
+        :param path: path of the SQLite database, created if it does not exist
+        :param batch_size: number of pending outcomes that triggers a write
+        '''
+
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.__runs__ = []
+        self.__outcomes__ = []
+
+        with self.connection:
+            for statement in _QCSTORE_SCHEMA:
+                self.connection.execute(statement)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+    def save_definition(self, check):
+        '''
+        Saves the definition of a check, replacing any previous definition with the same id.
+        '''
 
-        df_coverage = self.__dates_by_assets__.merge(df, on=['date', 'id'], how='outer')
+        definition = check.definition()
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?)',
+                                    (definition['id'], definition['type'], definition['type_description'],
+                                     definition['description'], _to_json(definition['parameters']),
+                                     pd.Timestamp.now().isoformat()))
 
-        print(df_coverage)
 
+    def definition(self, check_id):
+        '''
+        :return: the stored definition of a check, as returned by QCCheck.definition, None if not found
+        '''
+
+        row = self.connection.execute('SELECT check_id, type, type_description, description, parameters '
+                                      'FROM checks WHERE check_id = ?', (check_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {'id': row[0], 'type': row[1], 'type_description': row[2], 'description': row[3],
+                'parameters': json.loads(row[4])}
+
+
+    def load_check(self, check_id):
+        '''
+        :return: a new check built from its stored definition
+        '''
+
+        definition = self.definition(check_id)
+        if definition is None:
+            raise ValueError('No definition of check %s in %s' % (check_id, self.path))
+
+        return _CHECK_TYPES[definition['type']](id=definition['id'], description=definition['description'],
+                                                **definition['parameters'])
+
+
+    def save_result(self, result, dataset, run_at=None):
+        '''
+        Adds the result of a check to the pending writes.
+
+        :param result: QCResult
+        :param dataset: name of the dataset that was checked, e.g. the index name
+        :param run_at: time of the run, now if None
+        :return: the id of the run
+        '''
+
+        run_id = uuid.uuid4().hex
+        check_id = result.metadata.get('id')
+        run_at = pd.Timestamp.now() if run_at is None else pd.Timestamp(run_at)
 
-        # Sorts the coverage
+        self.__runs__.append((run_id, check_id, dataset, run_at.isoformat(), int(result.passed),
+                              len(result.flagged), _to_json(result.timings)))
 
-        df_coverage.sort_values(['id', 'date'], inplace=True)
+        summary = result.summary
+        flagged = result.flagged
 
-        df_coverage['next_date'] = df_coverage['date'].shift(-1)
-        df_coverage['previous_date'] = df_coverage['date'].shift(1)
-        df_coverage['next_id'] = df_coverage['id'].shift(-1)
-        df_coverage['previous_id'] = df_coverage['id'].shift(1)
-        df_coverage['next_sector'] = df_coverage['sector'].shift(-1)
-        df_coverage['previous_sector'] = df_coverage['sector'].shift(1)
+        if 'date' in flagged.columns:
+            n_flagged = flagged.groupby('date').size()
+        else:
+            n_flagged = None
+
+        if summary is not None and isinstance(summary.index, pd.DatetimeIndex):
+            dates = summary.index
+            if n_flagged is not None:
+                dates = dates.union(n_flagged.index)
+            n_flagged = n_flagged.reindex(dates, fill_value=0) if n_flagged is not None else pd.Series(0, index=dates)
+            summary = summary.reindex(dates)
+            records = summary.to_dict('records')
+            for date, count, record in zip(dates, n_flagged.values, records):
+                self.__outcomes__.append((run_id, check_id, dataset, date.strftime('%Y-%m-%d'), int(count == 0),
+                                          int(count), _to_json(record)))
+        elif n_flagged is not None and len(n_flagged):
+            for date, count in n_flagged.items():
+                self.__outcomes__.append((run_id, check_id, dataset, pd.Timestamp(date).strftime('%Y-%m-%d'), 0,
+                                          int(count), None))
+        else:
+            record = None if summary is None else summary.reset_index().to_dict('records')
+            self.__outcomes__.append((run_id, check_id, dataset, None, int(result.passed), len(flagged),
+                                      _to_json(record)))
+
+        if len(self.__outcomes__) >= self.batch_size:
+            self.flush()
+
+        return run_id
+
+
+    def save_results(self, results, dataset, run_at=None):
+        '''
+        Adds the results of several checks run at the same time, e.g. details['results'] of full_qc.
+
+        :param results: list or dictionary of QCResult
+        :return: list of run ids
+        '''
+
+        if isinstance(results, dict):
+            results = list(results.values())
+
+        run_at = pd.Timestamp.now() if run_at is None else run_at
+
+        return [self.save_result(result, dataset, run_at) for result in results]
 
 
-        df_coverage['drop_next_period'] = np.where((~df_coverage['sector'].isnull()) & (df_coverage['next_sector'].isnull()) & (df_coverage['next_id'] == df_coverage['id']), True, np.nan)
-        df_coverage['enter_this_period'] = np.where((~df_coverage['sector'].isnull()) & (df_coverage['previous_sector'].isnull()) & (df_coverage['previous_id'] == df_coverage['id']), True, np.nan)
+    def flush(self):
+        '''
+        Writes the pending results in a single transaction.
+        '''
 
+        if not self.__runs__ and not self.__outcomes__:
+            return
 
-        print(df_coverage)
+        with self.connection:
+            self.connection.executemany('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)', self.__runs__)
+            self.connection.executemany('INSERT INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?)', self.__outcomes__)
 
+        logger.debug('Wrote %d runs and %d outcomes to %s', len(self.__runs__), len(self.__outcomes__), self.path)
 
+        self.__runs__ = []
+        self.__outcomes__ = []
 
-        print(tabulate(df_coverage, headers='keys', tablefmt='psql'))
 
-        print(tabulate(df_coverage.sort_values(['date', 'id']), headers='keys', tablefmt='psql'))
+    def outcomes(self, check_id, dataset=None, start=None, end=None, failures_only=False):
+        '''
+        Reads the stored outcomes of a check by date, e.g. all the failures of a check over
+        the last year. Pending results are written first.
+
+        :param check_id: id of the check
+        :param dataset: optional dataset name
+        :param start: optional first date, inclusive
+        :param end: optional last date, inclusive
+        :param failures_only: whether to only return the dates with flagged rows
+        :return: dataframe with run_id, run_at, dataset, date, passed, n_flagged and summary
+        '''
 
-        # Create the summary count of how many securities enter and exit each period
-        print(df_coverage.groupby(['date'])['enter_this_period'].count())
-        print(df_coverage.groupby(['date'])['drop_next_period'].count())
+        self.flush()
 
+        query = ('SELECT o.run_id, r.run_at, o.dataset, o.date, o.passed, o.n_flagged, o.summary '
+                 'FROM outcomes o JOIN runs r ON o.run_id = r.run_id WHERE o.check_id = ?')
+        params = [check_id]
 
-        # Another way to do the analysis
-        groups = []
-        names = []
+        if dataset is not None:
+            query += ' AND o.dataset = ?'
+            params.append(dataset)
+        if start is not None:
+            query += ' AND o.date >= ?'
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            query += ' AND o.date <= ?'
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+        if failures_only:
+            query += ' AND o.passed = 0'
 
-        for name, group in df_coverage.groupby(['date']):
-            print(name)
-            print(tabulate(group, headers='keys', tablefmt='psql'))
-            names.append(name)
-            groups.append(group)
+        query += ' ORDER BY o.date, r.run_at'
 
-        for df in groups[1:-1]:
-            print(tabulate(df, headers='keys', tablefmt='psql'))
+        df = pd.read_sql_query(query, self.connection, params=params)
+        df['date'] = pd.to_datetime(df['date'])
+        df['run_at'] = pd.to_datetime(df['run_at'])
+        df['passed'] = df['passed'].astype(bool)
 
-        i = 1
-        while i < len(groups) - 1:
-            print('Previous group')
-            print(tabulate(groups[i-1], headers='keys', tablefmt='psql'))
-            print('Current group')
-            print(tabulate(groups[i], headers='keys', tablefmt='psql'))
-            print('Next group')
-            print(tabulate(groups[i+1], headers='keys', tablefmt='psql'))
-            i += 1
+        return df
 
 
 
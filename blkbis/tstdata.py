@@ -154,11 +154,12 @@ class HistoricalSampleData:
         if not hasattr(self, 'name'):
             self.__init__()
         self.show_info()
-        dates = blkbis.dates.create_date_series(self.start_date,
-                                                self.end_date,
-                                                self.data_frequency,
-                                                self.refix_frequency,
-                                                self.first_refix)
+        date_series = blkbis.dates.DatesSeries(self.start_date,
+                                               self.end_date,
+                                               self.data_frequency,
+                                               self.refix_frequency,
+                                               self.first_refix)
+        dates = date_series.build_time_series()
 
         master_list_ids = create_random_universe(n=15)
         master_list_sectors = create_random_universe(n=15)
@@ -185,7 +186,12 @@ class HistoricalSampleData:
 
         result = pd.concat(hist)
 
-        idx = blkidx.BlkIdx(self.name, dataframe=result)
+        # The refix dates are only built for the frequencies that have a fixed number of months
+        kwargs = {}
+        if self.refix_frequency in blkbis.dates._REFIX_MONTHS:
+            kwargs['refix_dates'] = date_series.build_refix_dates()
+
+        idx = blkidx.BlkIdx(self.name, dataframe=result, **kwargs)
 
         return idx
 
@@ -226,5 +232,6 @@ if __name__ == "__main__":
     df =  idx.idxdata
 
     qc_engine = qc.HistoricalPanelQCCheck(id='TEST', description='This is a test')
-    qc_engine.run_check(df)
+    qc_result = qc_engine.run_check(df)
+    print(qc_result.report())
 